@@ -0,0 +1,50 @@
+'''Measure how long it takes a fresh interpreter to import the githuborganizer entry points.
+
+Every target runs in its own subprocess so nothing is shared between measurements. Run with
+`python benchmarks/import_time.py [--runs N]` from the repository root.
+'''
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+TARGETS = [
+    ('baseline', 'pass'),
+    ('package', 'import githuborganizer'),
+    ('cli', 'import githuborganizer.cli'),
+    ('cli --help', 'import sys; sys.argv = ["cli", "--help"]; import githuborganizer.cli as c; c.cli()'),
+    ('models', 'import githuborganizer.models.gh'),
+    ('tasks', 'import githuborganizer.tasks.github'),
+    ('worker', 'import githuborganizer.worker'),
+]
+
+
+def time_target(code, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None, result.stderr.decode('utf-8').strip().splitlines()[-1]
+    return timings, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    print('%-12s %10s %10s' % ('target', 'median ms', 'min ms'))
+    for name, code in TARGETS:
+        timings, error = time_target(code, args.runs)
+        if error:
+            print('%-12s failed: %s' % (name, error))
+            continue
+        print('%-12s %10.1f %10.1f' % (name, statistics.median(timings) * 1000, min(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
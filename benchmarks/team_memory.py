@@ -0,0 +1,90 @@
+'''Measure the memory the team permission sweep needs for a synthetic large organization.
+
+Builds the per team repository permissions the old way (a list of permission names per
+repository) and the new way (a permissions.Team holding bit masks), plus one lean Repository per
+repository as the sweep streams them, and reports the peak traced allocation of each. Run with
+`python benchmarks/team_memory.py [--repositories N] [--teams N]` from the repository root.
+'''
+import argparse
+import gc
+import random
+import tracemalloc
+
+from githuborganizer.models import gh, permissions, snapshot
+
+
+LEVELS = ['pull', 'triage', 'push', 'maintain', 'admin']
+
+
+class FakeOrganization:
+    name = 'synthetic'
+
+
+def github_permissions(level):
+    granted = LEVELS[:LEVELS.index(level) + 1]
+    return {name: name in granted for name in LEVELS}
+
+
+def synthetic_listing(repositories, teams, seed=1):
+    '''Yield (team id, [(repository, GitHub permissions), ...]) with each team on a third of the repositories.'''
+    generator = random.Random(seed)
+    names = ['repository-%05d' % (index,) for index in range(repositories)]
+    for team in range(teams):
+        access = generator.sample(names, repositories // 3)
+        yield team, [(name, github_permissions(generator.choice(LEVELS))) for name in access]
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def build_lists(listing):
+    teams = []
+    for team, repositories in listing:
+        access = {}
+        for name, github in repositories:
+            access[name] = [permission for permission in github if github[permission]]
+        teams.append((team, access))
+    return teams
+
+
+def build_masks(listing):
+    teams = []
+    for team, repositories in listing:
+        access = {name: permissions.from_github(github) for name, github in repositories}
+        teams.append(permissions.Team(team, 'team-%s' % (team,), access))
+    return teams
+
+
+def build_repositories(count):
+    organization = FakeOrganization()
+    repositories = []
+    for index in range(count):
+        record = {'name': 'repository-%05d' % (index,), 'fork': False, 'archived': False, 'topics': []}
+        repositories.append(gh.Repository(None, organization, record['name'], repository_snapshot=snapshot.repository_snapshot(record)))
+    return repositories
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repositories', type=int, default=8000)
+    parser.add_argument('--teams', type=int, default=40)
+    args = parser.parse_args()
+
+    # The listings are generated up front so only the structures being compared are measured.
+    listing = list(synthetic_listing(args.repositories, args.teams))
+    print('%s repositories, %s teams' % (args.repositories, args.teams))
+    print('%-28s %10s' % ('structure', 'peak KiB'))
+    print('%-28s %10.0f' % ('permission name lists', measure(lambda: build_lists(listing)) / 1024))
+    print('%-28s %10.0f' % ('permission bit masks', measure(lambda: build_masks(listing)) / 1024))
+    print('%-28s %10.0f' % ('lean repositories', measure(lambda: build_repositories(args.repositories)) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+'''Measure how many webhooks a single www process can take in, and what each event type costs.
+
+Replays synthetic (or recorded) `issues`, `repository`, `installation` and
+`installation_repositories` webhooks against the FastAPI app in www.py at increasing rates. Celery
+publishes to kombu's in-memory transport, so the numbers cover the handler and the enqueue but no
+broker. The GitHub lookup the installation event makes is answered locally.
+
+For every rate it reports the accepted requests per second, and per event type the p50/p99
+handler latency and the time spent publishing tasks. Run with
+`python benchmarks/webhook_ingest.py [--rates 50,100,200] [--duration 5] [--replay events.jsonl]`
+from the repository root. A replay file has one `{"event": ..., "payload": ...}` object per line.
+'''
+import argparse
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('CELERY_BROKER', 'memory://')
+
+from fastapi.testclient import TestClient
+
+from githuborganizer import celery
+from githuborganizer import www
+
+
+EVENT_TYPES = ['issues', 'repository', 'installation', 'installation_repositories']
+
+
+def synthetic_repository(index):
+    name = 'repository-%05d' % (index,)
+    return {
+        'id': index,
+        'node_id': 'R_%s' % (index,),
+        'name': name,
+        'full_name': 'synthetic/%s' % (name,),
+        'owner': {'login': 'synthetic'},
+        'fork': False,
+        'archived': False,
+        'default_branch': 'main',
+        'topics': ['gho-default'],
+        'has_issues': True,
+        'has_wiki': False,
+        'has_downloads': True,
+        'has_projects': True,
+        'pushed_at': '2026-01-01T00:00:00Z',
+        'updated_at': '2026-01-01T00:00:00Z',
+    }
+
+
+def synthetic_event(event, index):
+    if event == 'issues':
+        return {
+            'action': 'opened',
+            'installation': {'id': 1},
+            'repository': synthetic_repository(index),
+            'issue': {'id': index, 'node_id': 'I_%s' % (index,), 'number': index, 'state': 'open',
+                'labels': [{'name': 'bug'}], 'updated_at': '2026-01-01T00:00:00Z'},
+        }
+    if event == 'repository':
+        return {'action': 'created', 'repository': synthetic_repository(index)}
+    if event == 'installation':
+        return {'action': 'created', 'installation': {'id': index}}
+    return {
+        'action': 'added',
+        'installation': {'id': 1},
+        'repositories_added': [synthetic_repository(index * 10 + offset) for offset in range(3)],
+    }
+
+
+def synthetic_stream():
+    for index in itertools.count():
+        event = EVENT_TYPES[index % len(EVENT_TYPES)]
+        yield event, synthetic_event(event, index)
+
+
+def replay_stream(path):
+    with open(path) as fd:
+        recorded = [json.loads(line) for line in fd if line.strip()]
+    for entry in itertools.cycle(recorded):
+        yield entry['event'], entry['payload']
+
+
+class LocalInstallation:
+
+    def get_organization(self):
+        return 'synthetic'
+
+
+class LocalApp:
+
+    def get_installation(self, installation_id):
+        return LocalInstallation()
+
+
+class Recorder:
+    '''Collects handler latencies and the time spent publishing tasks, per event type.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # The handler runs on another thread than the request, but it does inherit the context.
+        self.event = contextvars.ContextVar('event', default=None)
+        self.reset()
+
+    def reset(self):
+        self.latencies = {}
+        self.enqueue = {}
+        self.accepted = 0
+        self.rejected = 0
+
+    def add_enqueue(self, duration):
+        event = self.event.get()
+        with self.lock:
+            self.enqueue.setdefault(event, []).append(duration)
+
+    def add_request(self, event, duration, ok):
+        with self.lock:
+            self.latencies.setdefault(event, []).append(duration)
+            if ok:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+
+def instrument_publishing(recorder):
+    app = celery.get()
+    send_task = app.send_task
+
+    def timed_send_task(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return send_task(*args, **kwargs)
+        finally:
+            recorder.add_enqueue(time.perf_counter() - start)
+    app.send_task = timed_send_task
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_rate(rate, duration, stream, recorder, concurrency):
+    clients = threading.local()
+
+    def post(event, payload):
+        if not hasattr(clients, 'client'):
+            clients.client = TestClient(www.app)
+        recorder.event.set(event)
+        start = time.perf_counter()
+        response = clients.client.post('/githook', json=payload, headers={'X-GitHub-Event': event})
+        recorder.add_request(event, time.perf_counter() - start, response.status_code == 200)
+
+    recorder.reset()
+    total = int(rate * duration)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Open loop: requests go out on schedule whether or not earlier ones have finished.
+        for index in range(total):
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            event, payload = next(stream)
+            pool.submit(post, event, payload)
+    elapsed = time.perf_counter() - started
+    return recorder.accepted / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rates', default='50,100,200,400,800')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--replay', default=None)
+    args = parser.parse_args()
+
+    www.ghapp = LocalApp()
+    recorder = Recorder()
+    instrument_publishing(recorder)
+    stream = replay_stream(args.replay) if args.replay else synthetic_stream()
+
+    for rate in [float(rate) for rate in args.rates.split(',')]:
+        accepted = run_rate(rate, args.duration, stream, recorder, args.concurrency)
+        print('offered %6.0f/s  accepted %8.1f/s  rejected %s' % (rate, accepted, recorder.rejected))
+        print('  %-26s %8s %10s %10s %12s' % ('event', 'count', 'p50 ms', 'p99 ms', 'enqueue ms'))
+        for event in sorted(recorder.latencies):
+            latencies = recorder.latencies[event]
+            enqueue = recorder.enqueue.get(event, [])
+            print('  %-26s %8s %10.2f %10.2f %12.3f' % (
+                event,
+                len(latencies),
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                (sum(enqueue) / len(latencies)) * 1000,
+            ))
+
+
+if __name__ == '__main__':
+    main()
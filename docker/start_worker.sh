@@ -1,21 +1,53 @@
 #!/usr/bin/env bash
 
+# WORKER_LANES picks the queues this worker consumes (interactive, incremental and bulk). Run one
+# worker per lane so webhook reactions never wait behind a sweep; lane defaults are below.
+if [[ ! -v 'WORKER_LANES' ]]; then
+  WORKER_LANES='interactive,incremental,bulk'
+fi
+
+case "$WORKER_LANES" in
+  interactive)
+    # Short tasks someone is waiting on: a small pool that prefetches a few at a time.
+    DEFAULT_MINIMUM_WORKERS=2
+    DEFAULT_MAXIMUM_WORKERS=4
+    DEFAULT_PREFETCH=4
+    ;;
+  incremental)
+    DEFAULT_MINIMUM_WORKERS=2
+    DEFAULT_MAXIMUM_WORKERS=4
+    DEFAULT_PREFETCH=2
+    ;;
+  *)
+    # Long sweep tasks: prefetch one at a time so a busy worker does not hold work an idle one could take.
+    DEFAULT_MINIMUM_WORKERS=2
+    DEFAULT_MAXIMUM_WORKERS=10
+    DEFAULT_PREFETCH=1
+    ;;
+esac
+
 if [[ ! -v 'MINIMUM_WORKERS' ]]; then
-  MINIMUM_WORKERS=2
+  MINIMUM_WORKERS=$DEFAULT_MINIMUM_WORKERS
 fi
 
 if [[ ! -v 'MAXIMUM_WORKERS' ]]; then
-  MAXIMUM_WORKERS=10
+  MAXIMUM_WORKERS=$DEFAULT_MAXIMUM_WORKERS
 fi
 
+if [[ ! -v 'PREFETCH_MULTIPLIER' ]]; then
+  PREFETCH_MULTIPLIER=$DEFAULT_PREFETCH
+fi
+
+WORKER_OPTIONS="--loglevel=info --autoscale=$MAXIMUM_WORKERS,$MINIMUM_WORKERS -Q $WORKER_LANES --prefetch-multiplier=$PREFETCH_MULTIPLIER"
+
 if [ "$DISABLE_BEAT" = "true" ]
 then
   echo 'Launching celery worker without beat'
-  echo celery -A githuborganizer.worker.celery worker --loglevel=info --autoscale=$MAXIMUM_WORKERS,$MINIMUM_WORKERS
-  celery -A githuborganizer.worker.celery worker --loglevel=info --autoscale=$MAXIMUM_WORKERS,$MINIMUM_WORKERS
+  echo celery -A githuborganizer.worker.celery worker $WORKER_OPTIONS
+  celery -A githuborganizer.worker.celery worker $WORKER_OPTIONS
 else
   echo 'Launching celery worker with beat enabled'
   rm -f ~/celerybeat-schedule
-  echo celery -A githuborganizer.worker.celery worker --loglevel=info --autoscale=$MAXIMUM_WORKERS,$MINIMUM_WORKERS -B -s ~/celerybeat-schedule
-  celery -A githuborganizer.worker.celery worker --loglevel=info --autoscale=$MAXIMUM_WORKERS,$MINIMUM_WORKERS -B -s ~/celerybeat-schedule
+  echo celery -A githuborganizer.worker.celery worker $WORKER_OPTIONS -B -s ~/celerybeat-schedule
+  celery -A githuborganizer.worker.celery worker $WORKER_OPTIONS -B -s ~/celerybeat-schedule
 fi
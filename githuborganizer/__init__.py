@@ -1,7 +1,6 @@
-from celery import Celery
+import importlib.util
 import os
-from beaker.cache import CacheManager
-from beaker.util import parse_cache_config_options
+import sys
 
 
 SETTINGS = [
@@ -10,7 +9,24 @@ SETTINGS = [
     'GITHUB_APP_ID',
     'GITHUB_WEBHOOK_SECRET',
     'CELERY_BROKER',
-    'PROCESS_INSTALLS_INTERVAL']
+    'PROCESS_INSTALLS_INTERVAL',
+    'SWEEP_JITTER',
+    'STATE_DATABASE',
+    'INSTALLATION_CONCURRENCY',
+    'INSTALLATION_WEIGHTS',
+    'WRITE_CONCURRENCY',
+    'GRAPHQL_BATCH_SIZE',
+    'TRACE_FILE',
+    'TRACE_ENDPOINT',
+    'PROFILE_TASKS',
+    'PROFILE_DIRECTORY',
+    'PROFILE_THRESHOLD',
+    'PROFILE_KEEP',
+    'PAGE_CONCURRENCY',
+    'INTAKE_QUEUE_LIMIT',
+    'INTAKE_LAG_LIMIT',
+    'REQUEST_TIMEOUTS',
+    'TASK_SOFT_TIME_LIMIT']
 
 CONFIG = {}
 
@@ -19,16 +35,59 @@ for setting in SETTINGS:
         CONFIG[setting] = os.environ[setting]
 
 
-if 'CELERY_BROKER' in CONFIG:
-    celery = Celery('gitorganizer', broker=CONFIG['CELERY_BROKER'])
-else:
-    celery = Celery('gitorganizer')
+class Lazy:
+    '''Stands in for a singleton that is only built, with its imports, the first time it is used.'''
 
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
 
-cache_opts = {
-    'cache.type': 'file',
-    'cache.data_dir': '/tmp/gitorganizer/data',
-    'cache.lock_dir': '/tmp/gitorganizer/lock'
-}
+    def get(self):
+        if self._instance is None:
+            self._instance = self._factory()
+        return self._instance
 
-cache = CacheManager(**parse_cache_config_options(cache_opts))
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def lazy_import(name):
+    '''Import a module whose code only runs once one of its attributes is used.'''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def build_celery():
+    from celery import Celery
+    from githuborganizer import backpressure, lanes
+    from githuborganizer.services import timeouts
+    if 'CELERY_BROKER' in CONFIG:
+        app = Celery('gitorganizer', broker=CONFIG['CELERY_BROKER'])
+    else:
+        app = Celery('gitorganizer')
+    lanes.configure(app)
+    backpressure.configure(app)
+    timeouts.configure(app)
+    return app
+
+
+def build_cache():
+    from beaker.cache import CacheManager
+    from beaker.util import parse_cache_config_options
+    cache_opts = {
+        'cache.type': 'file',
+        'cache.data_dir': '/tmp/gitorganizer/data',
+        'cache.lock_dir': '/tmp/gitorganizer/lock'
+    }
+    return CacheManager(**parse_cache_config_options(cache_opts))
+
+
+celery = Lazy(build_celery)
+cache = Lazy(build_cache)
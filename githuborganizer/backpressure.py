@@ -0,0 +1,191 @@
+'''Keep webhook intake from burying the task queues during organization wide events.
+
+Before the webhook handler enqueues anything that is not interactive it looks at how many messages
+are waiting in the lanes and how long the interactive and incremental lanes have recently made
+tasks wait, and backs off in stages as either grows:
+
+* `COALESCE` - a task that is already waiting for the same repository is not queued again.
+* `DEFER` - low priority events are not queued at all; the organization gets a catch-up sweep
+  planned instead (see sweeps.py), which reconciles everything the events would have.
+* `SHED` - non-critical events are answered with a 503 and a Retry-After.
+
+Issue events are interactive and always go through. INTAKE_QUEUE_LIMIT (messages) and
+INTAKE_LAG_LIMIT (seconds) set where shedding starts; the earlier stages start at fractions of them.
+Queue depths are read from the broker at most every DEPTH_TTL seconds per process.
+
+The pending markers, planned sweeps and lane waits this relies on are written by one process and
+read by another, so the web server and the workers must share STATE_DATABASE (see state.py).
+'''
+import threading
+import time
+from githuborganizer import CONFIG, celery, lanes, sweeps
+from githuborganizer.services import state
+
+
+NORMAL = 0
+COALESCE = 1
+DEFER = 2
+SHED = 3
+LEVEL_NAMES = ['normal', 'coalesce', 'defer', 'shed']
+
+DEFAULT_QUEUE_LIMIT = 20000
+DEFAULT_LAG_LIMIT = 300
+# The fraction of the limits each stage starts at.
+THRESHOLDS = [(SHED, 1.0), (DEFER, 0.5), (COALESCE, 0.1)]
+
+# Lanes whose lag counts: the bulk lane is expected to lag during a sweep.
+LAG_LANES = [lanes.INTERACTIVE, lanes.INCREMENTAL]
+LAG_WINDOW = 5 * 60
+DEPTH_TTL = 5
+
+CRITICAL_EVENTS = ['issues']
+
+QUEUED = 'queued'
+COALESCED = 'coalesced'
+DEFERRED = 'deferred'
+REJECTED = 'rejected'
+
+PENDING = 'intake_pending'
+PENDING_HEADER = 'organizer_pending'
+PENDING_EXPIRE = 60 * 60
+STATS = 'intake_stats'
+
+lock = threading.Lock()
+measured = {'at': 0, 'pressure': None}
+
+
+def get_queue_limit():
+    return int(CONFIG.get('INTAKE_QUEUE_LIMIT', DEFAULT_QUEUE_LIMIT))
+
+
+def get_lag_limit():
+    return float(CONFIG.get('INTAKE_LAG_LIMIT', DEFAULT_LAG_LIMIT))
+
+
+def read_depths():
+    '''Messages waiting in each lane's queue, from the broker.'''
+    depths = {}
+    with celery.get().connection_for_read() as connection:
+        for lane in lanes.LANES:
+            # A passive declare of a queue nobody declared yet is an error that closes the channel.
+            channel = connection.channel()
+            try:
+                depths[lane] = channel.queue_declare(queue=lane, passive=True).message_count
+            except Exception:
+                depths[lane] = 0
+            finally:
+                channel.close()
+    return depths
+
+
+def read_lag(now=None):
+    '''The most recent queue wait of the lanes that have to stay responsive.'''
+    now = time.time() if now is None else now
+    waits = lanes.get_wait_stats()
+    lag = 0.0
+    for lane in LAG_LANES:
+        if lane in waits and now - waits[lane].get('updated', 0) < LAG_WINDOW:
+            lag = max(lag, waits[lane]['last'])
+    return lag
+
+
+def get_level_for(depth, lag):
+    for level, fraction in THRESHOLDS:
+        if depth >= get_queue_limit() * fraction or lag >= get_lag_limit() * fraction:
+            return level
+    return NORMAL
+
+
+def measure():
+    try:
+        depths = read_depths()
+    except Exception as e:
+        # Without a broker nothing can be queued anyway, so let the enqueue report it.
+        print('Unable to read queue depths: %s' % (e,))
+        depths = {}
+    depth = sum(depths.values())
+    lag = read_lag()
+    return {'level': get_level_for(depth, lag), 'depths': depths, 'lag': lag}
+
+
+def get_pressure():
+    with lock:
+        if measured['pressure'] is None or time.time() - measured['at'] >= DEPTH_TTL:
+            previous = measured['pressure']
+            measured['pressure'] = measure()
+            measured['at'] = time.time()
+            if previous is not None and previous['level'] != measured['pressure']['level']:
+                print('Webhook intake moved from %s to %s.' % (
+                    LEVEL_NAMES[previous['level']], LEVEL_NAMES[measured['pressure']['level']]))
+        return measured['pressure']
+
+
+def get_level():
+    return get_pressure()['level']
+
+
+def should_shed(event, level=None):
+    level = get_level() if level is None else level
+    return level >= SHED and event not in CRITICAL_EVENTS
+
+
+def retry_after():
+    '''Seconds GitHub (or whoever sent the webhook) should wait, roughly how far behind we are.'''
+    return int(min(10 * 60, max(30, get_pressure()['lag'])))
+
+
+def record(outcome):
+    state.increment(STATS, outcome)
+
+
+def get_stats():
+    return dict(state.items(STATS))
+
+
+def pending_key(task, args):
+    return '%s:%s' % (task.name, '/'.join(str(arg) for arg in args))
+
+
+def submit(organization, task, args, kwargs=None, queue=lanes.INCREMENTAL, level=None):
+    '''Enqueue a low priority webhook task, or coalesce or defer it while the queues are backed up.'''
+    level = get_level() if level is None else level
+    if level >= DEFER:
+        sweeps.plan(organization)
+        record(DEFERRED)
+        return DEFERRED
+    if level >= COALESCE:
+        key = pending_key(task, args)
+        with state.transaction():
+            pending = state.get(PENDING, key) is not None
+            if not pending:
+                state.set(PENDING, key, time.time(), expire=PENDING_EXPIRE)
+        if pending:
+            record(COALESCED)
+            return COALESCED
+        # The key is dropped when the task starts, so later events still see their changes applied.
+        task.apply_async(args, kwargs, queue=queue, headers={PENDING_HEADER: key})
+        return QUEUED
+    task.apply_async(args, kwargs, queue=queue)
+    return QUEUED
+
+
+def configure(app):
+    from celery.signals import task_failure, task_postrun, task_prerun
+    # Released when the task starts so events arriving meanwhile queue another run, and again
+    # when it ends in case the start was missed, so a repository is never coalesced for good.
+    task_prerun.connect(release_pending, weak=False)
+    task_postrun.connect(release_pending, weak=False)
+    task_failure.connect(release_failed, weak=False)
+
+
+def release_pending(task_id=None, task=None, **kwargs):
+    request = task.request
+    key = getattr(request, PENDING_HEADER, None)
+    if key is None:
+        key = (request.headers or {}).get(PENDING_HEADER)
+    if key is not None:
+        state.delete(PENDING, key)
+
+
+def release_failed(sender=None, task_id=None, **kwargs):
+    release_pending(task_id=task_id, task=sender)
@@ -1,19 +1,52 @@
 import click
-import github3
-import models.gh
-import tasks.github
-from githuborganizer.services.github import ghapp, get_organization_client
+from githuborganizer import lazy_import
 import random
 import string
 import os
-import config
+import time
+
+# Loaded on first use so `--help` and simple commands do not pay for celery, github3 and friends.
+github3 = lazy_import('github3')
+ghmodels = lazy_import('githuborganizer.models.gh')
+tasks = lazy_import('githuborganizer.tasks.github')
+services = lazy_import('githuborganizer.services.github')
+tracing = lazy_import('githuborganizer.services.tracing')
+leases = lazy_import('githuborganizer.services.leases')
+lanes = lazy_import('githuborganizer.lanes')
+singleflight = lazy_import('githuborganizer.services.singleflight')
+mirror = lazy_import('githuborganizer.models.mirror')
+policy = lazy_import('githuborganizer.models.policy')
+sweeps = lazy_import('githuborganizer.sweeps')
+backpressure = lazy_import('githuborganizer.backpressure')
+timeouts = lazy_import('githuborganizer.services.timeouts')
+default_branches = lazy_import('githuborganizer.models.default_branches')
+
+LIVE_HELP = "Ask GitHub instead of the local mirror."
+
+
+def use_mirror(organization, part, live):
+    '''Read only commands answer from the mirror once the worker has filled it in.'''
+    if live:
+        return False
+    if mirror.has_mirror(organization, part):
+        return True
+    click.echo('No local mirror of %s for %s yet, asking GitHub.' % (part, organization), err=True)
+    return False
 
 
 @click.group()
+@click.option('--profile', is_flag=True, help="Profile the command and save the cProfile output.")
 @click.pass_context
-def cli(ctx):
+def cli(ctx, profile):
     if ctx.parent:
         print(ctx.parent.get_help())
+    command = ctx.invoked_subcommand or 'cli'
+    if profile:
+        # Always keep the profile the user asked for, however fast the command was.
+        command_profile = tracing.Profile('cli-%s' % (command,), threshold=0).__enter__()
+        ctx.call_on_close(lambda: command_profile.__exit__(None, None, None))
+    command_span = tracing.span('cli %s' % (command,)).__enter__()
+    ctx.call_on_close(lambda: command_span.__exit__(None, None, None))
 
 
 @cli.command(short_help="Obtain an authorization token")
@@ -37,12 +70,25 @@ def auth():
 @cli.command(short_help="List the settings for an organization or repository")
 @click.argument('organization')
 @click.argument('repository', default=False)
-def settings(organization, repository):
-    gh = get_organization_client(organization)
-    org = models.gh.Organization(gh, organization)
+@click.option('--live', is_flag=True, help=LIVE_HELP)
+def settings(organization, repository, live):
+    if use_mirror(organization, 'configuration', live):
+        configuration = mirror.get_configuration(organization)
+        if not repository:
+            click.echo(configuration)
+            return
+        record = mirror.get_repository(organization, repository)
+        if record and 'profile' in record:
+            profile = record['profile']
+            organizer_settings = policy.get_policy(configuration).profiles[profile] if profile else False
+            click.echo(organizer_settings.as_dict() if organizer_settings else organizer_settings)
+            return
+    gh = services.get_organization_client(organization)
+    org = ghmodels.Organization(gh, organization)
     if repository:
         repo = org.get_repository(repository)
-        click.echo(repo.get_organizer_settings())
+        organizer_settings = repo.get_organizer_settings()
+        click.echo(organizer_settings.as_dict() if organizer_settings else organizer_settings)
     else:
         click.echo(org.configuration)
 
@@ -51,48 +97,67 @@ def settings(organization, repository):
 @click.argument('organization')
 @click.argument('repository')
 def update_repo(organization, repository):
-    tasks.github.update_repository_settings(organization, repository)
-    tasks.github.update_repository_labels(organization, repository)
-    tasks.github.update_repository_security_settings(organization, repository)
+    tasks.update_repository_settings(organization, repository)
+    tasks.update_repository_labels(organization, repository)
+    tasks.update_repository_security_settings(organization, repository)
 
 
 @cli.command(short_help="Update all repositories in an organization")
 @click.argument('organization')
-def update_repos(organization):
-    tasks.github.update_organization_settings(organization, True)
+@click.option('--full', is_flag=True, help="Reconcile every repository, even ones that look unchanged.")
+def update_repos(organization, full):
+    tasks.update_organization_settings(organization, True, full=full)
 
 
 @cli.command(short_help="Update repository teams for an organization")
 @click.argument('organization')
 def update_team_repos(organization):
-    tasks.github.update_organization_teams(organization)
+    tasks.update_organization_teams(organization)
 
 
 @cli.command(short_help="Update repository teams for an organization")
 @click.argument('organization')
 @click.argument('team')
-def get_team_permissions(organization, team):
-    installation = ghapp.get_org_installation(organization)
-    gh = get_organization_client(organization)
-    org = models.gh.Organization(gh, organization)
+@click.option('--live', is_flag=True, help=LIVE_HELP)
+def get_team_permissions(organization, team, live):
+    if use_mirror(organization, 'teams', live):
+        record = mirror.get_team(organization, team)
+        if record:
+            click.echo(record['repositories'])
+            return
+    installation = services.ghapp.get_org_installation(organization)
+    gh = services.get_organization_client(organization)
+    org = ghmodels.Organization(gh, organization)
     team = org.get_team_by_name(team)
-    click.echo(models.gh.team_has_repositories(installation, team))
+    repositories = ghmodels.team_has_repositories(installation, team)
+    click.echo({name: ghmodels.permissions.names(mask) for name, mask in repositories.items()})
 
 
 @cli.command(short_help="List the repositories in an organization")
 @click.argument('organization')
-def list_repos(organization):
-    gh = get_organization_client(organization)
-    org = models.gh.Organization(gh, organization)
+@click.option('--live', is_flag=True, help=LIVE_HELP)
+def list_repos(organization, live):
+    if use_mirror(organization, 'repositories', live):
+        for record in mirror.get_repositories(organization):
+            if not record.get('archived'):
+                click.echo(record['name'])
+        return
+    gh = services.get_organization_client(organization)
+    org = ghmodels.Organization(gh, organization)
     for repo in org.get_repositories():
         click.echo(repo.name)
 
 
 @cli.command(short_help="")
 @click.argument('organization')
-def list_org_projects(organization):
-    gh = get_organization_client(organization)
-    org = models.gh.Organization(gh, organization)
+@click.option('--live', is_flag=True, help=LIVE_HELP)
+def list_org_projects(organization, live):
+    if use_mirror(organization, 'projects', live):
+        for project in mirror.get_projects(organization):
+            click.echo('%s\t%s' % (project['id'], project['name']))
+        return
+    gh = services.get_organization_client(organization)
+    org = ghmodels.Organization(gh, organization)
     for project in org.get_projects():
         click.echo('%s\t%s' % (project.id, project.name))
 
@@ -100,9 +165,15 @@ def list_org_projects(organization):
 @cli.command(short_help="")
 @click.argument('organization')
 @click.argument('project')
-def get_org_project(organization, project):
-    gh = get_organization_client(organization)
-    org = models.gh.Organization(gh, organization)
+@click.option('--live', is_flag=True, help=LIVE_HELP)
+def get_org_project(organization, project, live):
+    if use_mirror(organization, 'projects', live):
+        record = mirror.get_project(organization, project)
+        if record:
+            click.echo('%s\t%s' % (record['id'], record['name']))
+            return
+    gh = services.get_organization_client(organization)
+    org = ghmodels.Organization(gh, organization)
     ghproject = org.get_project_by_name(project)
     click.echo('%s\t%s' % (ghproject.id, ghproject.name))
 
@@ -111,9 +182,15 @@ def get_org_project(organization, project):
 @click.argument('organization')
 @click.argument('project')
 @click.argument('column')
-def get_org_project_column(organization, project, column):
-    gh = get_organization_client(organization)
-    org = models.gh.Organization(gh, organization)
+@click.option('--live', is_flag=True, help=LIVE_HELP)
+def get_org_project_column(organization, project, column, live):
+    if use_mirror(organization, 'projects', live):
+        record = mirror.get_project(organization, project)
+        if record and column in record['columns']:
+            click.echo('%s\t%s' % (record['columns'][column], column))
+            return
+    gh = services.get_organization_client(organization)
+    org = ghmodels.Organization(gh, organization)
     project = org.get_project_by_name(project)
     column = project.get_column_by_name(column)
     click.echo('%s\t%s' % (column.id, column.name))
@@ -124,8 +201,8 @@ def get_org_project_column(organization, project, column):
 @click.argument('repository')
 @click.argument('project')
 def get_repo_project(organization, repository, project):
-    gh = get_organization_client(organization)
-    org = models.gh.Organization(gh, organization)
+    gh = services.get_organization_client(organization)
+    org = ghmodels.Organization(gh, organization)
     repo = org.get_repository(repository)
     ghproject = repo.get_project_by_name(project)
     click.echo('%s\t%s' % (ghproject.id, ghproject.name))
@@ -135,7 +212,7 @@ def get_repo_project(organization, repository, project):
 @click.argument('organization')
 @click.argument('repository')
 def update_branch_protection(organization, repository):
-    tasks.github.update_repo_branch_protection(organization, repository, synchronous=True)
+    tasks.update_repo_branch_protection(organization, repository, synchronous=True)
 
 
 @cli.command(short_help="")
@@ -143,7 +220,7 @@ def update_branch_protection(organization, repository):
 @click.argument('repository')
 @click.argument('issue')
 def assign_issue(organization, repository, issue):
-    tasks.github.assign_issue(organization, repository, issue)
+    tasks.assign_issue(organization, repository, issue)
 
 
 @cli.command(short_help="")
@@ -151,34 +228,131 @@ def assign_issue(organization, repository, issue):
 @click.argument('repository')
 @click.argument('issue')
 def label_issue(organization, repository, issue):
-    tasks.github.label_issue(organization, repository, issue)
+    tasks.label_issue(organization, repository, issue)
+
+
+@cli.command(short_help="Add open issues updated since the last run to the autoassign project")
+@click.argument('organization')
+@click.argument('repository')
+@click.option('--full', is_flag=True, help="Look at every open issue, not just recently updated ones.")
+def assign_issues(organization, repository, full):
+    tasks.assign_issues(organization, repository, synchronous=True, full=full)
+
+
+@cli.command(short_help="Add missing auto labels to open issues updated since the last run")
+@click.argument('organization')
+@click.argument('repository')
+@click.option('--full', is_flag=True, help="Look at every open issue, not just recently updated ones.")
+def label_issues(organization, repository, full):
+    tasks.label_issues(organization, repository, synchronous=True, full=full)
 
 
 @cli.command(short_help="")
 @click.argument('organization')
 @click.argument('team')
 def update_team_membership(organization, team):
-    tasks.github.update_team_members(organization, team)
+    tasks.update_team_members(organization, team)
 
 
 @cli.command(short_help="")
 @click.argument('organization')
 def update_org_team_membership(organization):
-    tasks.github.update_organization_team_members(organization, synchronous=True)
+    tasks.update_organization_team_members(organization, synchronous=True)
 
 
 @cli.command(short_help="")
 def app_info():
-    for install_id in ghapp.get_installations():
+    for install_id in services.ghapp.get_installations():
         click.echo('Install ID: %s' % (install_id))
-        install = ghapp.get_installation(install_id)
+        install = services.ghapp.get_installation(install_id)
         click.echo(install.get_organization())
 
 
+@cli.command(short_help="Show how often reconciles overlapped and were skipped or coalesced")
+@click.argument('organization', default=False)
+def reconcile_stats(organization):
+    for key, count in sorted(leases.get_stats(organization or None).items()):
+        click.echo('%s\t%s' % (key, count))
+
+
+@cli.command(short_help="Move every repository to the default branch its profile names")
+@click.argument('organization')
+@click.option('--dry-run', is_flag=True, help="Only list the repositories that would change.")
+def migrate_default_branches(organization, dry_run):
+    result = tasks.migrate_default_branches(organization, dry_run=dry_run)
+    if dry_run:
+        for change in result or []:
+            click.echo('%s\t%s -> %s%s' % (change['repository'], change['from'], change['to'], '\tcreate' if change['create'] else ''))
+        return
+    default_branch_progress.callback(organization)
+
+
+@cli.command(short_help="Show the progress of the last default branch migration")
+@click.argument('organization')
+def default_branch_progress(organization):
+    progress = default_branches.get_progress(organization)
+    if not progress:
+        click.echo('No default branch migration has run for %s.' % (organization,))
+        return
+    for key in ['status', 'total', 'created', 'updated', 'failed', 'deferred']:
+        click.echo('%s\t%s' % (key, progress[key]))
+
+
+@cli.command(short_help="Refresh the local mirror the read-only commands answer from")
+@click.argument('organization')
+def refresh_mirror(organization):
+    tasks.refresh_organization_mirror(organization, everything=True)
+    for part, refreshed in sorted(mirror.get_refreshed(organization).items()):
+        click.echo('%s\t%s' % (part, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(refreshed))))
+
+
+@cli.command(short_help="Show how many duplicate lookups were answered by one shared request")
+def singleflight_stats():
+    for name, saved in sorted(singleflight.get_stats().items()):
+        click.echo('%s\t%s' % (name, saved))
+
+
+@cli.command(short_help="Show how long tasks waited in each priority lane")
+def lane_stats():
+    for lane, waits in sorted(lanes.get_wait_stats().items()):
+        click.echo('%s\t%s tasks\taverage %0.2fs\tmax %0.2fs' % (lane, waits['count'], waits['average'], waits['max']))
+
+
+@cli.command(short_help="Show how backed up the queues are and what webhook intake shed")
+def intake_stats():
+    pressure = backpressure.measure()
+    click.echo('level\t%s' % (backpressure.LEVEL_NAMES[pressure['level']],))
+    click.echo('lag\t%0.2fs' % (pressure['lag'],))
+    for lane, depth in sorted(pressure['depths'].items()):
+        click.echo('%s\t%s waiting' % (lane, depth))
+    for outcome, count in sorted(backpressure.get_stats().items()):
+        click.echo('%s\t%s' % (outcome, count))
+
+
+@cli.command(short_help="Show task durations, time limit hits and cancelled GitHub calls")
+def timeout_stats():
+    for name, stats in sorted(timeouts.get_task_stats().items()):
+        click.echo('%s\t%s tasks\tp50 %0.2fs\tp99 %0.2fs\tmax %0.2fs' % (name, stats['count'], stats['p50'], stats['p99'], stats['max']))
+    for name, count in sorted(timeouts.get_limit_hits().items()):
+        click.echo('%s\t%s' % (name, count))
+    for endpoint, count in sorted(timeouts.get_stuck_calls().items()):
+        click.echo('cancelled %s calls\t%s' % (endpoint, count))
+
+
+@cli.command(short_help="Show when each organization's next periodic sweep is planned")
+def sweep_plan():
+    planned = sorted(sweeps.get_planned().items(), key=lambda item: item[1]['due'])
+    for organization, sweep in planned:
+        click.echo('%s\t%s%s' % (
+            organization,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sweep['due'])),
+            '\tfull' if sweep['full'] else ''))
+
+
 @cli.command(short_help="")
 @click.argument('organization')
 def org_info(organization):
-    click.echo(ghapp.get_org_installation(organization))
+    click.echo(services.ghapp.get_org_installation(organization))
 
 
 
@@ -0,0 +1,81 @@
+'''Priority lanes so quick webhook reactions never wait behind a bulk sweep.
+
+Every task goes to one of three celery queues:
+
+* `interactive` - reactions a person is waiting on, such as labelling a newly opened issue.
+* `incremental` - single repository or organization changes from webhooks, and housekeeping.
+* `bulk` - everything handed out by the fair scheduler during periodic and full sweeps.
+
+Tasks listed in TASK_LANES always default to their lane, callers can pick a lane with
+`apply_async(queue=...)`, and anything else lands in `bulk`. Each lane is meant to be consumed by
+its own worker pool with its own concurrency and prefetch (see docker/start_worker.sh). How long
+tasks sat in each lane's queue is recorded in the state store.
+'''
+import time
+from githuborganizer.services import state
+
+
+INTERACTIVE = 'interactive'
+INCREMENTAL = 'incremental'
+BULK = 'bulk'
+LANES = [INTERACTIVE, INCREMENTAL, BULK]
+DEFAULT_LANE = BULK
+
+TASK_LANES = {
+    'githuborganizer.tasks.github.assign_issue': INTERACTIVE,
+    'githuborganizer.tasks.github.label_issue': INTERACTIVE,
+    'githuborganizer.tasks.github.dispatch_scheduled_tasks': INCREMENTAL,
+    'githuborganizer.tasks.github.retry_deferred_writes': INCREMENTAL,
+}
+
+WAITS = 'lane_waits'
+ENQUEUED_HEADER = 'organizer_enqueued'
+
+
+def get_lane(task_name):
+    return TASK_LANES.get(task_name, DEFAULT_LANE)
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    return {'queue': get_lane(name)}
+
+
+def configure(app):
+    '''Set up routing and queue wait tracking on a celery application.'''
+    from celery.signals import before_task_publish, task_prerun
+    app.conf.task_default_queue = DEFAULT_LANE
+    app.conf.task_routes = (route_task,)
+    before_task_publish.connect(stamp_enqueued, weak=False)
+    task_prerun.connect(record_wait, weak=False)
+
+
+def stamp_enqueued(headers=None, **kwargs):
+    if headers is not None:
+        headers[ENQUEUED_HEADER] = time.time()
+
+
+def record_wait(task_id=None, task=None, **kwargs):
+    request = task.request
+    enqueued = getattr(request, ENQUEUED_HEADER, None)
+    if enqueued is None:
+        enqueued = (request.headers or {}).get(ENQUEUED_HEADER)
+    if enqueued is None:
+        return
+    lane = (request.delivery_info or {}).get('routing_key') or get_lane(task.name)
+    wait = max(0.0, time.time() - float(enqueued))
+    with state.transaction():
+        waits = state.get(WAITS, lane, {'count': 0, 'total': 0.0, 'max': 0.0})
+        waits['count'] += 1
+        waits['total'] += wait
+        waits['max'] = max(waits['max'], wait)
+        waits['last'] = wait
+        waits['updated'] = time.time()
+        state.set(WAITS, lane, waits)
+
+
+def get_wait_stats():
+    stats = {}
+    for lane, waits in state.items(WAITS):
+        waits['average'] = waits['total'] / waits['count'] if waits['count'] else 0.0
+        stats[lane] = waits
+    return stats
@@ -0,0 +1,153 @@
+'''Move an organization's repositories over to the default branch the configuration names.
+
+Changing default branches one repository at a time took a repository lookup, a branch lookup, an
+attempt at creating the branch and an edit for every repository, whether or not anything had to
+change. A migration instead lists the organization once, 100 repositories per GraphQL request,
+with each repository's default branch, its head and whether the wanted branch already exists. Only
+repositories that are on the wrong branch are touched: missing branches are created from the
+current head with batched `createRef` mutations, then the default branches are switched in
+parallel. Both go through the installation's write throttle, so rate limited writes are deferred
+and the next migration picks up anything left over. Progress is kept in the state store.
+'''
+import time
+from concurrent.futures import ThreadPoolExecutor
+from githuborganizer.models import gh, mirror
+from githuborganizer.services import batch, state, throttle
+
+
+MIGRATIONS = 'default_branch_migrations'
+
+CREATED = 'created'
+UPDATED = 'updated'
+FAILED = 'failed'
+DEFERRED = 'deferred'
+
+
+def get_targets(organization_policy):
+    '''The branch names any profile wants as its default.'''
+    targets = set()
+    for profile in organization_policy.profiles.values():
+        for name, branch in profile.branches.items():
+            if branch.default:
+                targets.add(name)
+                break
+    return targets
+
+
+def plan(org):
+    '''List the changes the organization needs as [{'repository', 'node_id', 'from', 'to', 'head_sha', 'create'}].'''
+    if not org.policy:
+        return []
+    targets = get_targets(org.policy)
+    if not targets:
+        return []
+    listing = list(gh.list_default_branches(org.client.app, org.name, targets))
+    records = {record['name']: record for record in listing}
+    changes = []
+    # build_repositories applies the exclusions and keeps the listing as each repository's snapshot.
+    for repo in org.build_repositories(listing):
+        record = records[repo.name]
+        if not record['default_branch']:
+            # Empty repositories have no branch to start from.
+            continue
+        target = repo.get_default_branch_target()
+        if not target or record['default_branch'] == target:
+            continue
+        changes.append({
+            'repository': repo.name,
+            'node_id': record['node_id'],
+            'from': record['default_branch'],
+            'to': target,
+            'head_sha': record['head_sha'],
+            'create': record['branches'].get(target) is None,
+        })
+    return changes
+
+
+def start(organization, changes):
+    state.set(MIGRATIONS, organization, {
+        'total': len(changes),
+        CREATED: 0,
+        UPDATED: 0,
+        FAILED: 0,
+        DEFERRED: 0,
+        'status': 'running',
+        'started': time.time(),
+    })
+
+
+def count(organization, outcome, amount=1):
+    with state.transaction():
+        progress = state.get(MIGRATIONS, organization)
+        if not progress:
+            return
+        progress[outcome] += amount
+        state.set(MIGRATIONS, organization, progress)
+
+
+def finish(organization):
+    with state.transaction():
+        progress = state.get(MIGRATIONS, organization)
+        if not progress:
+            return
+        progress['status'] = 'finished'
+        progress['finished'] = time.time()
+        state.set(MIGRATIONS, organization, progress)
+
+
+def get_progress(organization):
+    return state.get(MIGRATIONS, organization)
+
+
+def create_branches(org, changes):
+    '''Create the missing branches in batches. Returns the changes whose branch now exists.'''
+    mutations = batch.MutationBatch(org.client.app)
+    for change in changes:
+        mutations.add('createRef', {
+            'repositoryId': change['node_id'],
+            'name': 'refs/heads/%s' % (change['to'],),
+            'oid': change['head_sha'],
+        })
+    ready = []
+    for change, result in zip(changes, mutations.execute()):
+        if result == batch.DEFERRED:
+            # Retried later on its own; the default branch waits for the next migration.
+            count(org.name, DEFERRED)
+        elif isinstance(result, batch.MutationError) and 'already exists' not in str(result):
+            print('Unable to create %s in %s/%s: %s' % (change['to'], org.name, change['repository'], result))
+            count(org.name, FAILED)
+        else:
+            count(org.name, CREATED)
+            ready.append(change)
+    return ready
+
+
+def update_default_branch(org, change):
+    try:
+        with throttle.tracking() as writes:
+            result = org.client.app.rest('patch', 'repos/%s/%s' % (org.name, change['repository']), {'default_branch': change['to']})
+    except Exception as e:
+        print('Unable to set the default branch of %s/%s to %s: %s' % (org.name, change['repository'], change['to'], e))
+        count(org.name, FAILED)
+        return
+    if result is False:
+        # Nothing retries a write the throttle gave up on.
+        count(org.name, FAILED if writes.given_up else DEFERRED)
+        return
+    print('Default branch of %s/%s is now %s.' % (org.name, change['repository'], change['to']))
+    mirror.record_repository(org.name, {'name': change['repository'], 'default_branch': change['to']})
+    count(org.name, UPDATED)
+
+
+def migrate(org, changes=None):
+    '''Apply a plan, creating branches in batches and switching default branches in parallel.'''
+    changes = plan(org) if changes is None else changes
+    start(org.name, changes)
+    ready = [change for change in changes if not change['create']]
+    ready += create_branches(org, [change for change in changes if change['create']])
+    if ready:
+        # The write throttle decides how many of these really run at once.
+        with ThreadPoolExecutor(max_workers=min(len(ready), int(throttle.get_max_limit()))) as pool:
+            list(pool.map(lambda change: update_default_branch(org, change), ready))
+    finish(org.name)
+    return get_progress(org.name)
@@ -0,0 +1,101 @@
+'''Fingerprints of what we last applied to a repository, used to skip unchanged repositories.
+
+For every repository and aspect we record a hash of the desired settings and a hash of the
+observed repository state (from the listing snapshot) after a successful apply. A sweep that finds
+both hashes unchanged can skip the aspect without making a single request.
+
+Editing labels or branch protection changes neither timestamp in the listing, so those aspects also
+keep the ETag of the labels or of the branch's protection. Checking them is a conditional request,
+which costs no rate limit when GitHub answers 304, and a hand edit changes the ETag and so the
+fingerprint. Fingerprints expire after a day so other drift is still corrected; a full reconcile
+ignores them entirely.
+'''
+import hashlib
+import json
+from githuborganizer.models import gh, policy
+from githuborganizer.services import state
+
+
+FINGERPRINTS = 'repository_fingerprints'
+FINGERPRINT_EXPIRE = 24 * 60 * 60 # One day
+OBSERVED_FIELDS = ['updated_at', 'pushed_at']
+
+
+def digest(value):
+    encoded = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def desired_state(repository, aspect):
+    organizer_settings = repository.get_organizer_settings()
+    if not organizer_settings:
+        return None
+    if aspect == 'settings':
+        return [organizer_settings.features.as_dict(), organizer_settings.merges.as_dict()]
+    if aspect == 'labels':
+        organization_policy = repository.organization.policy
+        return [[label.as_dict() for label in organization_policy.labels], organization_policy.labels_clean]
+    if aspect == 'security':
+        return policy.thaw(organizer_settings.dependency_security)
+    if aspect.startswith('branches:'):
+        return policy.thaw(organizer_settings.branches.get(aspect[9:]))
+    return organizer_settings.as_dict()
+
+
+def observed_state(repository):
+    if not repository.snapshot:
+        return None
+    observed = [repository.snapshot.get(field) for field in OBSERVED_FIELDS]
+    if None in observed:
+        return None
+    return observed
+
+
+def get_etag(repository, aspect, etag=None):
+    '''ETag of what the aspect manages beyond the listing, '' for aspects without one, None if unknown.'''
+    installation = repository.client.app
+    try:
+        if aspect == 'labels':
+            return gh.get_labels_etag(installation, repository, etag)
+        if aspect.startswith('branches:'):
+            return gh.get_branch_protection_etag(installation, repository, aspect[9:], etag)
+    except Exception as e:
+        print('Unable to check %s of %s: %s' % (aspect, repository.name, e))
+        return None
+    return ''
+
+
+def get_key(repository, aspect):
+    return '%s/%s/%s' % (repository.organization.name, repository.name, aspect)
+
+
+def is_current(repository, aspect):
+    observed = observed_state(repository)
+    if observed is None:
+        return False
+    fingerprint = state.get(FINGERPRINTS, get_key(repository, aspect))
+    if not fingerprint:
+        return False
+    if fingerprint['desired'] != digest(desired_state(repository, aspect)):
+        return False
+    if fingerprint['observed'] != digest(observed):
+        return False
+    # Only asked once everything else matched, and with the recorded ETag so it is usually a 304.
+    recorded_etag = fingerprint.get('etag', '')
+    etag = get_etag(repository, aspect, recorded_etag)
+    return etag is not None and etag == recorded_etag
+
+
+def record(repository, aspect):
+    observed = observed_state(repository)
+    if observed is None:
+        return
+    etag = get_etag(repository, aspect)
+    if etag is None:
+        return
+    state.set(FINGERPRINTS, get_key(repository, aspect), {
+        'desired': digest(desired_state(repository, aspect)),
+        'observed': digest(observed),
+        'etag': etag,
+    }, expire=FINGERPRINT_EXPIRE)
+
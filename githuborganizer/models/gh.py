@@ -1,20 +1,16 @@
-import base64
-import datetime
-import githuborganizer.config as config
 from githuborganizer import cache
+from githuborganizer.models import permissions, policy, snapshot
+from githuborganizer.services import batch, singleflight, tracing
 import github3
-from github3apps import GithubApp
 import json
-import requests
 import yaml
-import os
-from copy import copy
+from urllib.parse import quote
 
 
-DEFAULT_LABEL_COLOR = '000000'
 CACHE_SHORT = 5 * 60 # Five minutes
 CACHE_MEDIUM = 60 * 60 # One hour
 CACHE_LONG = 24 * 60 * 60 # One day
+LABELS_PREVIEW = 'application/vnd.github.bane-preview+json'
 
 def issue_has_projects(installation, organization, repository, issue):
     query = '''
@@ -36,23 +32,233 @@ def issue_has_projects(installation, organization, repository, issue):
     return len(results['data']['repository']['issue']['projectCards']['edges']) > 0
 
 
+REPOSITORY_LISTING_QUERY = '''
+query($organization: String!, $cursor: String, $isFork: Boolean) {
+  organization(login: $organization) {
+    repositories(first: 100, after: $cursor, isFork: $isFork, orderBy: {field: NAME, direction: ASC}) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        id
+        name
+        isFork
+        isArchived
+        updatedAt
+        pushedAt
+        defaultBranchRef {
+          name
+        }
+        repositoryTopics(first: 20) {
+          nodes {
+            topic {
+              name
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+
+def list_repository_page(installation, organization, exclude_forks=False, cursor=None):
+    '''Return one page of slim repository records and the cursor of the next page, or None.'''
+    variables = {'organization': organization, 'cursor': cursor}
+    if exclude_forks:
+        variables['isFork'] = False
+    with tracing.span('organization listing', organization=organization, cursor=cursor):
+        results = installation.graphql({'query': REPOSITORY_LISTING_QUERY, 'variables': variables})
+    repositories = results['data']['organization']['repositories']
+    records = []
+    for node in repositories['nodes']:
+        records.append({
+            'node_id': node['id'],
+            'name': node['name'],
+            'fork': node['isFork'],
+            'archived': node['isArchived'],
+            'updated_at': node['updatedAt'],
+            'pushed_at': node['pushedAt'],
+            'default_branch': node['defaultBranchRef']['name'] if node['defaultBranchRef'] else None,
+            'topics': [x['topic']['name'] for x in node['repositoryTopics']['nodes']],
+        })
+    if not repositories['pageInfo']['hasNextPage']:
+        return records, None
+    return records, repositories['pageInfo']['endCursor']
+
+
+def list_repositories(installation, organization, exclude_forks=False):
+    '''Yield slim repository records, 100 to a request, using only the fields we need.'''
+    cursor = None
+    while True:
+        records, cursor = list_repository_page(installation, organization, exclude_forks, cursor)
+        for record in records:
+            yield record
+        if not cursor:
+            return
+
+
+DEFAULT_BRANCH_QUERY = '''
+query($organization: String!, $cursor: String%s) {
+  organization(login: $organization) {
+    repositories(first: 100, after: $cursor, isFork: false, orderBy: {field: NAME, direction: ASC}) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        id
+        name
+        isFork
+        isArchived
+        defaultBranchRef {
+          name
+          target {
+            oid
+          }
+        }
+        repositoryTopics(first: 20) {
+          nodes {
+            topic {
+              name
+            }
+          }
+        }
+%s
+      }
+    }
+  }
+}
+'''
+
+
+def list_default_branches(installation, organization, branches):
+    '''Yield every non fork repository with its default branch, that branch's head and whether
+    each of the given branches exists (the oid it points at, or None), 100 repositories a request.
+    '''
+    branches = sorted(branches)
+    declarations = ''.join(', $branch%s: String!' % (index,) for index in range(len(branches)))
+    fields = '\n'.join('        branch%s: ref(qualifiedName: $branch%s) { target { oid } }' % (index, index) for index in range(len(branches)))
+    query = DEFAULT_BRANCH_QUERY % (declarations, fields)
+    cursor = None
+    while True:
+        variables = {'organization': organization, 'cursor': cursor}
+        for index, branch in enumerate(branches):
+            variables['branch%s' % (index,)] = 'refs/heads/%s' % (branch,)
+        with tracing.span('default branch listing', organization=organization, cursor=cursor):
+            results = installation.graphql({'query': query, 'variables': variables})
+        repositories = results['data']['organization']['repositories']
+        for node in repositories['nodes']:
+            default_branch = node['defaultBranchRef']
+            yield {
+                'node_id': node['id'],
+                'name': node['name'],
+                'fork': node['isFork'],
+                'archived': node['isArchived'],
+                'default_branch': default_branch['name'] if default_branch else None,
+                'head_sha': default_branch['target']['oid'] if default_branch else None,
+                'topics': [x['topic']['name'] for x in node['repositoryTopics']['nodes']],
+                'branches': {
+                    branch: node['branch%s' % (index,)]['target']['oid'] if node['branch%s' % (index,)] else None
+                    for index, branch in enumerate(branches)
+                },
+            }
+        if not repositories['pageInfo']['hasNextPage']:
+            return
+        cursor = repositories['pageInfo']['endCursor']
+
+
+OPEN_ISSUES_QUERY = '''
+query($organization: String!, $repository: String!, $cursor: String, $since: DateTime) {
+  repository(owner: $organization, name: $repository) {
+    issues(first: 100, after: $cursor, states: OPEN, filterBy: {since: $since}, orderBy: {field: UPDATED_AT, direction: ASC}) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        id
+        number
+        updatedAt
+        labels(first: 100) {
+          nodes {
+            name
+          }
+        }
+        projectCards(first: 1, archivedStates: NOT_ARCHIVED) {
+          totalCount
+        }
+      }
+    }
+  }
+}
+'''
+
+
+def list_open_issues(installation, organization, repository, since=None):
+    '''Yield the open issues, oldest update first, optionally only those updated since a time.'''
+    cursor = None
+    while True:
+        variables = {'organization': organization, 'repository': repository, 'cursor': cursor, 'since': since}
+        results = installation.graphql({'query': OPEN_ISSUES_QUERY, 'variables': variables})
+        issues = results['data']['repository']['issues']
+        for node in issues['nodes']:
+            yield {
+                'node_id': node['id'],
+                'number': node['number'],
+                'updated_at': node['updatedAt'],
+                'labels': [label['name'] for label in node['labels']['nodes']],
+                'project_cards': node['projectCards']['totalCount'],
+            }
+        if not issues['pageInfo']['hasNextPage']:
+            return
+        cursor = issues['pageInfo']['endCursor']
+
+
+def add_issue_labels(installation, organization, repository, issue, labels):
+    # POST /repos/:owner/:repo/issues/:issue_number/labels
+    return installation.rest(
+        'post',
+        'repos/%s/%s/issues/%s/labels' % (organization, repository, issue),
+        payload={'labels': list(labels)}
+    )
+
+
+def set_team_repository_permission(installation, team, repository, permission):
+    # PUT /teams/:team_id/repos/:owner/:repo
+    return installation.rest(
+        'put',
+        'teams/%s/repos/%s' % (team.id, repository),
+        payload={'permission': permission},
+        accepts=['application/vnd.github.hellcat-preview+json']
+    )
+
+
+def remove_team_repository(installation, team, repository):
+    # DELETE /teams/:team_id/repos/:owner/:repo
+    return installation.rest('delete', 'teams/%s/repos/%s' % (team.id, repository))
+
+
 def team_has_repositories(installation, team):
+    '''Map the name of every repository the team can access to its permissions.Permission mask.'''
     # GET /teams/:team_id/repos
-    results = installation.rest(
-        'get',
+    results = installation.paginate(
         'teams/%s/repos' % (team.id),
-        payload=False,
         accepts=['application/vnd.github.hellcat-preview+json']
     )
     repositories = {}
     for repo in results:
-        repositories[repo['name']] = []
-        for permission in repo['permissions']:
-            if repo['permissions'][permission]:
-                repositories[repo['name']].append(permission)
+        repositories[repo['name']] = permissions.from_github(repo['permissions'])
     return repositories
 
 
+def get_team_access(installation, team):
+    '''A compact permissions.Team in place of the github3 team and its repository listing.'''
+    return permissions.Team(team.id, team.name, team_has_repositories(installation, team))
+
+
 def branch_protection(
     installation,
     repository,
@@ -69,10 +275,18 @@ def branch_protection(
     dismiss_stale_reviews = True
     ):
 
+    # Policies are shared and immutable, so work on plain copies.
+    required_status_checks = policy.thaw(required_status_checks)
+    restrictions = policy.thaw(restrictions)
+    if required_status_checks is True:
+        required_status_checks = {}
+    if restrictions is True:
+        restrictions = {}
+
     # required_status_checks
     # - strict - boolean
     # - contexts - array, leave empty for "all"
-    if required_status_checks:
+    if required_status_checks is not None:
         if 'contexts' not in required_status_checks:
             required_status_checks['contexts'] = []
         if 'strict' not in required_status_checks:
@@ -134,6 +348,25 @@ def branch_protection(
     )
 
 
+def get_labels_etag(installation, repository, etag=None):
+    '''ETag of the repository's first page of labels, which changes with any label edit on it.'''
+    # GET /repos/:owner/:repo/labels
+    return installation.get_etag(
+        'https://api.github.com/repos/%s/%s/labels?per_page=100' % (repository.organization.name, repository.name),
+        etag=etag,
+        accepts=[LABELS_PREVIEW]
+    )
+
+
+def get_branch_protection_etag(installation, repository, branch, etag=None):
+    # GET /repos/:owner/:repo/branches/:branch/protection
+    return installation.get_etag(
+        'https://api.github.com/repos/%s/%s/branches/%s/protection' % (repository.organization.name, repository.name, branch),
+        etag=etag,
+        accepts=['application/vnd.github.luke-cage-preview+json']
+    )
+
+
 class Organization:
 
     def __repr__(self):
@@ -144,6 +377,7 @@ class Organization:
 
     def __init__(self, client, organization):
         @cache.cache(expire=CACHE_SHORT)
+        @singleflight.shared('configuration')
         def get_configuration(org_name):
             try:
                 config_repository = client.repository(org_name, '.github')
@@ -157,8 +391,10 @@ class Organization:
 
         self.client = client
         self.name = organization
-        self.configuration = get_configuration(organization)
+        with tracing.span('organization configuration', organization=organization):
+            self.configuration = get_configuration(organization)
         self._ghorg = False
+        self._policy = None
 
 
     @property
@@ -168,20 +404,47 @@ class Organization:
             self._ghorg = self.client.organization(self.name)
         return self._ghorg
 
-
-    def get_repositories(self):
-        for repository in self.ghorg.repositories():
-            if 'exclude_repositories' in self.configuration:
-                if repository.name in self.configuration['exclude_repositories']:
-                    continue
-            if self.configuration.get('exclude_forks', False) and repository.fork:
+    @property
+    def policy(self):
+        '''The compiled configuration, or False when the organization does not have one.'''
+        if not self.configuration:
+            return False
+        if self._policy is None:
+            self._policy = policy.get_policy(self.configuration)
+        return self._policy
+
+    def get_repositories(self, lean=True):
+        '''List the repositories to manage, without excluded, forked (if configured) or archived ones.
+
+        The lean listing asks GraphQL for just the fields the sweeps use. Pass lean=False to list
+        full github3 repository objects instead.
+        '''
+        if lean:
+            listing = list_repositories(self.client.app, self.name, self.policy.exclude_forks)
+        else:
+            listing = (repository.as_dict() for repository in self.ghorg.repositories())
+        return self.build_repositories(listing)
+
+    def get_repository_page(self, cursor=None):
+        '''Return one page of repositories to manage and the cursor of the next page, or None.'''
+        listing, next_cursor = list_repository_page(self.client.app, self.name, self.policy.exclude_forks, cursor)
+        return list(self.build_repositories(listing)), next_cursor
+
+    def build_repositories(self, listing):
+        exclude = self.policy.exclude_repositories
+        for repository in listing:
+            if repository['name'] in exclude:
+                continue
+            if self.policy.exclude_forks and repository['fork']:
                 continue
-            if repository.archived:
+            if repository['archived']:
                 continue
-            yield Repository(self.client, self, repository.name, repository)
+            # The listing already has the fields we need, so keep them and skip the per repo lookups.
+            repository_snapshot = snapshot.repository_snapshot(repository)
+            yield Repository(self.client, self, repository['name'], repository_snapshot=repository_snapshot)
 
-    def get_repository(self, name):
-        return Repository(self.client, self, name)
+    def get_repository(self, name, topics=None, repository_snapshot=None):
+        return Repository(self.client, self, name, topics=topics, repository_snapshot=repository_snapshot)
 
     def get_projects(self):
         for project in self.ghorg.projects():
@@ -189,6 +452,7 @@ class Organization:
 
     def get_project_by_name(self, name):
         @cache.cache(expire=CACHE_MEDIUM)
+        @singleflight.shared('organization_project')
         def org_get_project_id_from_name(org, name):
             for project in org.ghorg.projects():
                 if project.name == name:
@@ -201,6 +465,7 @@ class Organization:
 
     def get_team_by_name(self, name):
         @cache.cache(expire=CACHE_MEDIUM)
+        @singleflight.shared('team')
         def org_get_team_id_from_name(org, name):
             accepts = ['application/vnd.github.hellcat-preview+json']
             endpoint = 'orgs/%s/teams/%s' % (org.name, name)
@@ -216,6 +481,8 @@ class Organization:
 
 
 class Repository:
+    # Sweeps create one of these per repository, so keep them small.
+    __slots__ = ('client', 'organization', 'name', '_ghrep', 'snapshot', '_topics')
 
     def __repr__(self):
         return 'OrganizerRepository %s/%s' % (self.organization.name, self.name)
@@ -223,13 +490,21 @@ class Repository:
     def __str__(self):
         return self.__repr__()
 
-    def __init__(self, client, organization, repo_name, ghrep=None):
+    def __init__(self, client, organization, repo_name, ghrep=None, topics=None, repository_snapshot=None):
         self.client = client
         self.organization = organization
         self.name = repo_name
         self._ghrep = False
         if ghrep:
             self._ghrep = ghrep
+        # Topics and snapshots can be passed in from a webhook payload to avoid API calls.
+        self.snapshot = repository_snapshot
+        if topics is None:
+            try:
+                topics = snapshot.get_field(repository_snapshot, 'topics')
+            except KeyError:
+                pass
+        self._topics = topics
 
     @property
     def ghrep(self):
@@ -238,171 +513,196 @@ class Repository:
             self._ghrep = self.client.repository(self.organization.name, self.name)
         return self._ghrep
 
+    def get_attribute(self, field):
+        '''Read a repository field from the snapshot, only fetching the repository when we must.'''
+        try:
+            return snapshot.get_field(self.snapshot, field)
+        except KeyError:
+            return getattr(self.ghrep, field)
+
+    def get_node_id(self):
+        try:
+            return snapshot.get_field(self.snapshot, 'node_id')
+        except KeyError:
+            return self.ghrep.as_dict()['node_id']
+
     def update_settings(self):
         organizer_settings = self.get_organizer_settings()
-        self.ghrep.edit(self.name,
-            has_issues = organizer_settings.get('features', {}).get('has_issues', None),
-            has_wiki = organizer_settings.get('features', {}).get('has_wiki', None),
-            has_downloads = organizer_settings.get('features', {}).get('has_downloads', None),
-            has_projects = organizer_settings.get('features', {}).get('has_projects', None),
-            allow_rebase_merge = organizer_settings.get('merges', {}).get('allow_rebase_merge', None),
-            allow_squash_merge = organizer_settings.get('merges', {}).get('allow_squash_merge', None),
-            allow_merge_commit = organizer_settings.get('merges', {}).get('allow_merge_commit', None),
-            #delete_branch_on_merge = organizer_settings.get('delete_branch_on_merge', None),
-        )
-
-    def update_default_branch(self):
-        org_settings = self.get_organizer_settings()
-        if 'branches' not in org_settings:
+        if not organizer_settings:
+            return
+        repo_settings = organizer_settings.features.as_dict()
+        repo_settings.update(organizer_settings.merges.as_dict())
+        #repo_settings['delete_branch_on_merge'] = organizer_settings.delete_branch_on_merge
+        repo_settings = {key: value for key, value in repo_settings.items() if value is not None}
+        if not repo_settings:
+            return
+        if snapshot.matches(self.snapshot, repo_settings):
             return
+        results = self.client.app.rest(
+            'patch',
+            'repos/%s/%s' % (self.organization.name, self.name),
+            payload=repo_settings)
+        # The edit changes the repository, so track what it looks like now.
+        if isinstance(results, dict):
+            self.snapshot = snapshot.repository_snapshot(results)
+        return results
+
+    def get_default_branch_target(self):
+        '''The branch the configuration wants as default, or None if it does not name one.'''
+        org_settings = self.get_organizer_settings()
+        if not org_settings or not org_settings.branches:
+            return None
+        for branch, settings in org_settings.branches.items():
+            if settings.default:
+                return branch
+        return None
 
+    def update_default_branch(self):
         # If this repo is a fork then leave it alone.
-        if self.ghrep.source:
+        if self.get_attribute('fork'):
             return
 
-        for branch in org_settings['branches']:
-            settings = org_settings['branches'][branch]
-            if "default" not in settings:
-                continue
-            if not settings["default"]:
-                continue
-            if self.ghrep.default_branch == branch:
-                return
+        branch = self.get_default_branch_target()
+        if not branch or self.get_attribute('default_branch') == branch:
+            return
 
-            # Fails if branch exists, creates it from current default branch otherwise.
-            # Saves us at least one API call to see if the branch exists
-            try:
-                self.create_branch(branch)
-            except:
-                pass
-            return self.ghrep.edit(self.name, default_branch=branch)
+        # Fails if branch exists, creates it from current default branch otherwise.
+        # Saves us at least one API call to see if the branch exists
+        try:
+            self.create_branch(branch)
+        except github3.exceptions.UnprocessableEntity:
+            pass
+        return self.ghrep.edit(self.name, default_branch=branch)
 
 
 
     def get_labels(self):
         labels = {}
-        for label in self.ghrep.labels():
-            labels[label.name] = label
+        results = self.client.app.rest('get', 'repos/%s/%s/labels' % (self.organization.name, self.name))
+        for label in results:
+            labels[label['name']] = label
         return labels
 
 
     def get_topics(self):
-        topics = {}
-        return self.ghrep.topics().names
-
+        if self._topics is None:
+            self._topics = self.ghrep.topics().names
+        return self._topics
 
-    def get_organizer_settings(self, name = False, maxdepth = 5):
-        topic_assignment = False
-        if self.organization.configuration.get("topics_for_assignment", True):
-            topics = self.get_topics()
-            topic_assignments = [x for x in topics if x.startswith("gho-")]
-            if len(topic_assignments) == 1:
-                topic_assignment = topic_assignments[0][4:]
 
-        if not self.organization.configuration:
+    def get_organizer_settings(self):
+        '''Return the shared RepositoryPolicy for this repository's profile, or False.'''
+        organization_policy = self.organization.policy
+        if not organization_policy:
             return False
-        elif 'repositories' not in self.organization.configuration:
-            '''Convert from the old style configuration to the current version'''
-            settings = copy(self.organization.configuration)
-            settings['merges'] = {}
-            settings['features'] = {}
-            if 'labels' in settings:
-                del settings['labels']
-            for feature in ['has_issues', 'has_wiki', 'has_downloads', 'has_projects']:
-                if feature in settings:
-                    settings['features'][feature] = settings[feature]
-                    del settings[feature]
-            for merge in ['allow_rebase_merge', 'allow_squash_merge', 'allow_merge_commit']:
-                if merge in settings:
-                    settings['merges'][merge] = settings[merge]
-                    del settings[merge]
-            return settings
-        elif name and name in self.organization.configuration['repositories']:
-            settings = self.organization.configuration['repositories'][name]
-        elif topic_assignment and topic_assignment in self.organization.configuration['repositories']:
-            settings = self.organization.configuration['repositories'][topic_assignment]
-        elif not name and self.name in self.organization.configuration['repositories']:
-            settings = self.organization.configuration['repositories'][self.name]
-        elif 'default' in self.organization.configuration['repositories']:
-            settings = self.organization.configuration['repositories']['default']
-        if not settings:
+        with tracing.span('repository settings', repository=self.name):
+            profile = self.get_profile_name()
+        if not profile:
             return False
-
-        if isinstance(settings, str):
-            settings = {'extends':settings}
-
-        if 'extends' in settings and maxdepth > 0:
-            parent = self.get_organizer_settings(name=settings['extends'], maxdepth=maxdepth-1)
-            if parent:
-                parent.update(settings)
-                settings = parent
-            del settings['extends']
-
-        return settings
+        return organization_policy.profiles[profile]
+
+    def get_profile_name(self):
+        organization_policy = self.organization.policy
+        if organization_policy.legacy:
+            return 'default'
+        if organization_policy.topics_for_assignment:
+            topic_assignments = [x for x in self.get_topics() if x.startswith("gho-")]
+            if len(topic_assignments) == 1 and topic_assignments[0] in organization_policy.topic_profiles:
+                return organization_policy.topic_profiles[topic_assignments[0]]
+        if self.name in organization_policy.repository_profiles:
+            return organization_policy.repository_profiles[self.name]
+        if 'default' in organization_policy.profiles:
+            return 'default'
+        return False
 
     def update_labels(self):
+        current_labels = self.get_labels()
+        operations = self.plan_labels(current_labels)
+        with tracing.span('repository labels', repository=self.name, operations=len(operations)):
+            if batch.should_batch(operations):
+                self.apply_labels_graphql(operations, current_labels)
+            else:
+                self.apply_labels_rest(operations)
 
-        current_labels = self.get_labels() #[x.name for x in self.ghrep.labels()]
+    def plan_labels(self, current_labels):
+        '''Work out which label writes are needed to match the configuration.'''
+        organization_policy = self.organization.policy
+        current_labels = dict(current_labels)
+        operations = []
 
         # Remove any labels not in the configuration
-        if self.organization.configuration.get('labels_clean', False):
-            label_names = [x['name'] for x in self.organization.configuration.get('labels', [])]
-            for active_label in self.ghrep.labels():
-                if active_label.name not in label_names:
-                    active_label.delete()
-
-        for config_label in self.organization.configuration.get('labels', []):
-            if config_label.get('old_name'):
-                label_object = self.ghrep.label(config_label['old_name'])
-                if label_object:
-                    label_object.update(
-                        config_label['name'],
-                        config_label.get('color', DEFAULT_LABEL_COLOR),
-                        config_label.get('description', None))
-                    continue
-
-            if config_label['name'] in current_labels:
-                label_object = current_labels[config_label['name']] #self.ghrep.label(config_label['name'])
-                if not label_matches(config_label, label_object):
-                    label_object.update(
-                        config_label['name'],
-                        config_label.get('color', DEFAULT_LABEL_COLOR),
-                        config_label.get('description', None))
+        if organization_policy.labels_clean:
+            label_names = [x.name for x in organization_policy.labels]
+            for active_label in list(current_labels):
+                if active_label not in label_names:
+                    operations.append({'action': 'delete', 'name': active_label})
+                    del current_labels[active_label]
+
+        for config_label in organization_policy.labels:
+            label_payload = {
+                'name': config_label.name,
+                'color': config_label.color,
+                'description': config_label.description
+            }
+            if config_label.old_name and config_label.old_name in current_labels:
+                operations.append({'action': 'update', 'name': config_label.old_name, 'payload': label_payload})
+                continue
+
+            if config_label.name in current_labels:
+                if not label_matches(config_label, current_labels[config_label.name]):
+                    operations.append({'action': 'update', 'name': config_label.name, 'payload': label_payload})
+            else:
+                operations.append({'action': 'create', 'name': config_label.name, 'payload': label_payload})
+        return operations
+
+    def apply_labels_rest(self, operations):
+        labels_endpoint = 'repos/%s/%s/labels' % (self.organization.name, self.name)
+        for operation in operations:
+            label_endpoint = '%s/%s' % (labels_endpoint, quote(operation['name'], safe=''))
+            if operation['action'] == 'delete':
+                self.client.app.rest('delete', label_endpoint)
+            elif operation['action'] == 'update':
+                label_payload = dict(operation['payload'])
+                label_payload['new_name'] = label_payload.pop('name')
+                self.client.app.rest('patch', label_endpoint, payload=label_payload)
             else:
-                self.ghrep.create_label(
-                    config_label['name'],
-                    config_label.get('color', DEFAULT_LABEL_COLOR),
-                    config_label.get('description', None))
+                self.client.app.rest('post', labels_endpoint, payload=operation['payload'])
+
+    def apply_labels_graphql(self, operations, current_labels):
+        mutations = batch.MutationBatch(self.client.app, accepts=LABELS_PREVIEW)
+        for operation in operations:
+            if operation['action'] == 'delete':
+                mutations.add('deleteLabel', {'id': current_labels[operation['name']]['node_id']})
+            elif operation['action'] == 'update':
+                label_input = dict(operation['payload'])
+                label_input['id'] = current_labels[operation['name']]['node_id']
+                mutations.add('updateLabel', label_input)
+            else:
+                label_input = dict(operation['payload'])
+                label_input['repositoryId'] = self.get_node_id()
+                mutations.add('createLabel', label_input)
+        for operation, result in zip(operations, mutations.execute()):
+            if isinstance(result, batch.MutationError):
+                print('Unable to %s label %s on %s: %s' % (operation['action'], operation['name'], self, result))
 
     def update_issues(self):
-        organizer_settings = self.get_organizer_settings()
-        if not organizer_settings:
+        column = self.get_autoassign_column()
+        if not column:
             return False
-        if 'auto_assign_project' not in organizer_settings['issues']:
-            return False
-
-        issue_config = organizer_settings['issues']
-
-        if 'organization' in issue_config:
-            project = self.organization.ghorg.project(issue_config['name'])
-        else:
-            project = self.ghrep.project(issue_config['name'])
-        project_column = project.column(issue_config['column'])
-
         for issue in self.ghrep.issues(state='open', sort='created', direction='asc'):
-            project_column.create_card_with_issue(issue)
+            column.create_card_with_issue(issue)
 
     def update_security_scanning(self):
         organizer_settings = self.get_organizer_settings()
         if not organizer_settings:
             return False
-        if 'dependency_security' not in organizer_settings:
+        if not organizer_settings.dependency_security:
             return False
-        sec = organizer_settings['dependency_security']
-        if 'alerts' in sec:
-            self.toggle_vulnerability_alerts(sec['alerts'])
-        if 'automatic_fixes' in sec:
-            self.toggle_security_fixes(sec['automatic_fixes'])
+        sec = organizer_settings.dependency_security
+        if sec.alerts is not None:
+            self.toggle_vulnerability_alerts(sec.alerts)
+        if sec.automatic_fixes is not None:
+            self.toggle_security_fixes(sec.automatic_fixes)
 
     def toggle_vulnerability_alerts(self, enable):
         flag = 'application/vnd.github.dorian-preview+json'
@@ -422,6 +722,7 @@ class Repository:
 
     def get_project_by_name(self, name):
         @cache.cache(expire=CACHE_MEDIUM)
+        @singleflight.shared('repository_project')
         def repo_get_project_id_from_name(repo, name):
             for project in repo.get_projects():
                 if project.name == name:
@@ -439,38 +740,42 @@ class Repository:
     def get_issue(self, issue_id):
         return self.ghrep.issue(issue_id)
 
+    def get_issue_id(self, issue_number, issue_snapshot=None):
+        try:
+            return snapshot.get_field(issue_snapshot, 'id')
+        except KeyError:
+            return self.get_issue(issue_number).id
+
     def get_autoassign_project(self):
         organizer_settings = self.get_organizer_settings()
         if not organizer_settings:
             return False
-        if not 'issues' in organizer_settings:
+        if not organizer_settings.issues:
             return False
-        if not 'project_autoassign' in organizer_settings['issues']:
+        if not organizer_settings.issues.project_autoassign:
             return False
-        autoassign = organizer_settings['issues']['project_autoassign']
-        if autoassign['organization']:
-            return self.organization.get_project_by_name(autoassign['name'])
-        if autoassign['repository']:
-            return self.organization.get_repository(autoassign['repository']).get_project_by_name(autoassign['name'])
-        return self.get_project_by_name(autoassign['name'])
+        autoassign = organizer_settings.issues.project_autoassign
+        if autoassign.organization:
+            return self.organization.get_project_by_name(autoassign.name)
+        if autoassign.repository:
+            return self.organization.get_repository(autoassign.repository).get_project_by_name(autoassign.name)
+        return self.get_project_by_name(autoassign.name)
 
     def get_autoassign_column(self):
         organizer_settings = self.get_organizer_settings()
         project = self.get_autoassign_project()
         if not project:
             return False
-        return project.get_column_by_name(organizer_settings['issues']['project_autoassign']['column'])
+        return project.get_column_by_name(organizer_settings.issues.project_autoassign.column)
 
     def get_autoassign_labels(self):
         organizer_settings = self.get_organizer_settings()
-        if 'issues' in organizer_settings and 'auto_label' in organizer_settings['issues']:
-            labels = set(organizer_settings['issues']['auto_label'])
+        if organizer_settings and organizer_settings.issues:
+            labels = set(organizer_settings.issues.auto_label)
         else:
             labels = set([])
-        if 'labels' in self.organization.configuration:
-            for label in self.organization.configuration['labels']:
-                if 'repos' in label and self.name in label['repos']:
-                    labels.add(label['name'])
+        if self.organization.policy:
+            labels |= self.organization.policy.repository_labels.get(self.name, frozenset())
         if len(labels) > 0:
             return labels
         return False
@@ -504,6 +809,7 @@ class Project:
 
     def get_column_by_name(self, name):
         @cache.cache(expire=CACHE_MEDIUM)
+        @singleflight.shared('column')
         def get_column_id_from_name(project, name):
             for column in project.get_columns():
                 if column.name == name:
@@ -516,8 +822,8 @@ class Project:
 
 
 def label_matches(config_label, label):
-    if label.color != config_label.get('color', DEFAULT_LABEL_COLOR):
+    if label['color'] != config_label.color:
         return False
-    if label.description != config_label.get('description', None):
+    if label['description'] != config_label.description:
         return False
     return True
@@ -0,0 +1,124 @@
+'''A local copy of each organization's state for the read-only CLI commands.
+
+The worker writes what it already learns while reconciling (the configuration, every repository it
+lists with its topics and resolved profile, team permissions) and a periodic refresh adds projects
+and their columns. Repository webhooks keep the repository list current between sweeps. Reading it
+costs a SQLite query instead of a walk over the API, at the price of being as old as the last
+refresh; the CLI's `--live` flag goes to GitHub instead.
+'''
+import time
+from githuborganizer.models import permissions
+from githuborganizer.services import state
+
+
+CONFIGURATIONS = 'mirror_configurations'
+REPOSITORIES = 'mirror_repositories'
+TEAMS = 'mirror_teams'
+PROJECTS = 'mirror_projects'
+REFRESHED = 'mirror_refreshed'
+
+REPOSITORY_FIELDS = ['name', 'fork', 'archived', 'default_branch', 'topics', 'updated_at', 'pushed_at']
+
+
+def touch(organization, part):
+    state.set(REFRESHED, '%s/%s' % (organization, part), time.time())
+
+
+def get_refreshed(organization):
+    prefix = '%s/' % (organization,)
+    return {key[len(prefix):]: refreshed for key, refreshed in state.items(REFRESHED, prefix)}
+
+
+def has_mirror(organization, part):
+    return state.get(REFRESHED, '%s/%s' % (organization, part)) is not None
+
+
+def record_configuration(organization, configuration):
+    state.set(CONFIGURATIONS, organization, configuration)
+    touch(organization, 'configuration')
+
+
+def get_configuration(organization):
+    return state.get(CONFIGURATIONS, organization)
+
+
+def record_repository(organization, data, profile=None, listing=None):
+    '''Store a repository from a snapshot, listing record or webhook payload.
+
+    Only a full listing fills in the repository list, so a single repository does not mark it
+    refreshed. Listings pass their id, which `prune_repositories` uses to find the ones now gone.
+    '''
+    record = {field: data[field] for field in REPOSITORY_FIELDS if field in data}
+    if profile is not None:
+        record['profile'] = profile
+    if listing is not None:
+        record['listing'] = listing
+    key = '%s/%s' % (organization, data['name'])
+    with state.transaction():
+        # Webhooks do not know the profile, so keep the one the worker resolved last.
+        existing = state.get(REPOSITORIES, key) or {}
+        existing.update(record)
+        state.set(REPOSITORIES, key, existing)
+
+
+def prune_repositories(organization, listing):
+    '''Finish a full listing: drop repositories an earlier listing saw but this one did not.
+
+    Repositories only known from webhooks are kept until a listing has seen them.
+    '''
+    with state.transaction():
+        for key, record in state.items(REPOSITORIES, '%s/' % (organization,)):
+            if record.get('listing') not in (None, listing):
+                state.delete(REPOSITORIES, key)
+    touch(organization, 'repositories')
+
+
+def remove_repository(organization, name):
+    state.delete(REPOSITORIES, '%s/%s' % (organization, name))
+
+
+def get_repositories(organization):
+    return [record for _, record in state.items(REPOSITORIES, '%s/' % (organization,))]
+
+
+def get_repository(organization, name):
+    return state.get(REPOSITORIES, '%s/%s' % (organization, name))
+
+
+def record_team(organization, team):
+    '''Store a permissions.Team with its permission masks spelled out as names.'''
+    state.set(TEAMS, '%s/%s' % (organization, team.name), {
+        'id': team.id,
+        'name': team.name,
+        'repositories': {name: permissions.names(mask) for name, mask in team.repositories.items()},
+    })
+    touch(organization, 'teams')
+
+
+def prune_teams(organization, names):
+    '''Drop the teams not in names, after recording every team of the organization.'''
+    with state.transaction():
+        for key, team in state.items(TEAMS, '%s/' % (organization,)):
+            if team['name'] not in names:
+                state.delete(TEAMS, key)
+
+
+def get_team(organization, name):
+    return state.get(TEAMS, '%s/%s' % (organization, name))
+
+
+def record_projects(organization, projects):
+    '''Replace the organization's projects with [{'id', 'name', 'columns': {name: id}}, ...].'''
+    with state.transaction():
+        state.clear(PROJECTS, '%s/' % (organization,))
+        for project in projects:
+            state.set(PROJECTS, '%s/%s' % (organization, project['name']), project)
+    touch(organization, 'projects')
+
+
+def get_projects(organization):
+    return [project for _, project in state.items(PROJECTS, '%s/' % (organization,))]
+
+
+def get_project(organization, name):
+    return state.get(PROJECTS, '%s/%s' % (organization, name))
@@ -0,0 +1,59 @@
+'''Compact records for the team permission sweep.
+
+Sweeping the teams of a large organization used to keep every team's repository listing as dicts
+of permission name lists. Here a team is a small `__slots__` record and its access to a repository
+is a single integer bit mask of the permissions GitHub reports, so a team with access to thousands
+of repositories costs one dict of str to int.
+'''
+from enum import IntFlag
+
+
+class Permission(IntFlag):
+    PULL = 1
+    TRIAGE = 2
+    PUSH = 4
+    MAINTAIN = 8
+    ADMIN = 16
+
+
+NONE = Permission(0)
+
+
+def from_name(name):
+    return Permission[name.upper()]
+
+
+def from_github(permissions):
+    '''Convert GitHub's {"pull": true, "push": false, ...} into a bit mask.'''
+    mask = NONE
+    for name, granted in permissions.items():
+        if granted and name.upper() in Permission.__members__:
+            mask |= Permission[name.upper()]
+    return mask
+
+
+def names(mask):
+    return [permission.name.lower() for permission in Permission if permission & mask]
+
+
+def count(mask):
+    return bin(int(mask)).count('1')
+
+
+class Team:
+    __slots__ = ('id', 'name', 'repositories')
+
+    def __repr__(self):
+        return 'OrganizerTeam %s' % self.name
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __init__(self, id, name, repositories=None):
+        self.id = id
+        self.name = name
+        # Repository name to Permission mask, for the repositories the team can access.
+        self.repositories = repositories if repositories is not None else {}
+
+    def get_permissions(self, repository):
+        return self.repositories.get(repository, NONE)
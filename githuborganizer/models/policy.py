@@ -0,0 +1,336 @@
+'''Organizer configuration compiled into small, immutable policy objects.
+
+The yaml configuration is compiled once per configuration version. Every profile under
+`repositories` (with its `extends` chain already applied) becomes a RepositoryPolicy. Repositories
+using the same profile share the same object, so picking a repository's settings is a lookup and
+the cached configuration can not be changed by accident. Mistakes in the configuration are
+reported as a PolicyError when it is compiled rather than halfway through a run.
+'''
+import hashlib
+import json
+from collections import OrderedDict
+from types import MappingProxyType
+
+
+MAX_EXTENDS_DEPTH = 5
+COMPILED_VERSIONS = 32
+DEFAULT_LABEL_COLOR = '000000'
+TEAM_PERMISSIONS = ['pull', 'triage', 'push', 'maintain', 'admin']
+FEATURES = ['has_issues', 'has_wiki', 'has_downloads', 'has_projects']
+MERGES = ['allow_rebase_merge', 'allow_squash_merge', 'allow_merge_commit']
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def config_version(configuration):
+    encoded = json.dumps(configuration, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    '''Return a plain, mutable copy of a frozen value, for API payloads and display.'''
+    if isinstance(value, Policy):
+        return value.as_dict()
+    if isinstance(value, (dict, MappingProxyType)):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (set, frozenset)):
+        # Set order follows the hash seed, so sort to keep payloads and fingerprints stable.
+        return sorted((thaw(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True, default=str))
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class Policy:
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % (type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % (type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __hash__(self):
+        return hash(json.dumps(self.as_dict(), sort_keys=True, default=str))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+    def __str__(self):
+        return self.__repr__()
+
+    def as_dict(self):
+        return {name: thaw(getattr(self, name)) for name in self.__slots__}
+
+
+class FeaturesPolicy(Policy):
+    __slots__ = ('has_issues', 'has_wiki', 'has_downloads', 'has_projects')
+
+
+class MergesPolicy(Policy):
+    __slots__ = ('allow_rebase_merge', 'allow_squash_merge', 'allow_merge_commit')
+
+
+class BranchPolicy(Policy):
+    __slots__ = (
+        'name',
+        'default',
+        'required_status_checks',
+        'enforce_admins',
+        'required_pull_request_reviews',
+        'restrictions',
+        'required_linear_history',
+        'allow_force_pushes',
+        'allow_deletions',
+        'required_approving_review_count',
+        'require_code_owner_reviews',
+        'dismiss_stale_reviews',
+    )
+
+
+class ProjectAutoassignPolicy(Policy):
+    __slots__ = ('organization', 'repository', 'name', 'column')
+
+
+class IssuesPolicy(Policy):
+    __slots__ = ('auto_label', 'project_autoassign')
+
+
+class SecurityPolicy(Policy):
+    __slots__ = ('alerts', 'automatic_fixes')
+
+
+class LabelPolicy(Policy):
+    __slots__ = ('name', 'color', 'description', 'old_name', 'repos')
+
+
+class RepositoryPolicy(Policy):
+    __slots__ = (
+        'profile',
+        'features',
+        'merges',
+        'branches',
+        'teams',
+        'teams_clean',
+        'issues',
+        'dependency_security',
+        'delete_branch_on_merge',
+    )
+
+
+class OrganizationPolicy(Policy):
+    __slots__ = (
+        'version',
+        'legacy',
+        'profiles',
+        'labels',
+        'labels_clean',
+        'exclude_repositories',
+        'exclude_forks',
+        'topics_for_assignment',
+        'topic_profiles',
+        'repository_profiles',
+        'repository_labels',
+    )
+
+
+def expect(condition, message, *args):
+    if not condition:
+        raise PolicyError(message % args)
+
+
+def expect_mapping(value, where):
+    expect(value is None or isinstance(value, dict), '%s must be a mapping.', where)
+    return value or {}
+
+
+def expect_bool(value, where):
+    expect(value is None or isinstance(value, bool), '%s must be true or false.', where)
+    return value
+
+
+def compile_features(settings, profile):
+    features = expect_mapping(settings.get('features'), '%s features' % (profile))
+    return FeaturesPolicy(**{name: expect_bool(features.get(name), '%s features.%s' % (profile, name)) for name in FEATURES})
+
+
+def compile_merges(settings, profile):
+    merges = expect_mapping(settings.get('merges'), '%s merges' % (profile))
+    return MergesPolicy(**{name: expect_bool(merges.get(name), '%s merges.%s' % (profile, name)) for name in MERGES})
+
+
+def compile_branch(name, settings, profile):
+    where = '%s branches.%s' % (profile, name)
+    settings = expect_mapping(settings, where)
+    count = settings.get('required_approving_review_count', 1)
+    expect(isinstance(count, int) and not isinstance(count, bool), '%s required_approving_review_count must be a number.', where)
+    for field in ['required_status_checks', 'restrictions']:
+        value = settings.get(field, None)
+        expect(value is None or isinstance(value, (dict, bool)), '%s %s must be a mapping.', where, field)
+    return BranchPolicy(
+        name=name,
+        default=bool(settings.get('default', False)),
+        required_status_checks=freeze(settings.get('required_status_checks', None)),
+        enforce_admins=bool(settings.get('enforce_admins', False)),
+        required_pull_request_reviews=freeze(settings.get('required_pull_request_reviews', None)),
+        restrictions=freeze(settings.get('restrictions', None)),
+        required_linear_history=bool(settings.get('required_linear_history', False)),
+        allow_force_pushes=bool(settings.get('allow_force_pushes', False)),
+        allow_deletions=bool(settings.get('allow_deletions', False)),
+        required_approving_review_count=count,
+        require_code_owner_reviews=bool(settings.get('require_code_owner_reviews', False)),
+        dismiss_stale_reviews=bool(settings.get('dismiss_stale_reviews', True)),
+    )
+
+
+def compile_teams(settings, profile):
+    teams = {}
+    for team, permission in expect_mapping(settings.get('teams'), '%s teams' % (profile)).items():
+        expect(isinstance(permission, str) and permission.lower() in TEAM_PERMISSIONS,
+            '%s teams.%s must be one of %s.', profile, team, ', '.join(TEAM_PERMISSIONS))
+        teams[team] = permission.lower()
+    return MappingProxyType(teams)
+
+
+def compile_issues(settings, profile):
+    if 'issues' not in settings:
+        return None
+    issues = expect_mapping(settings['issues'], '%s issues' % (profile))
+    auto_label = issues.get('auto_label', [])
+    expect(isinstance(auto_label, list), '%s issues.auto_label must be a list.', profile)
+    project_autoassign = None
+    if 'project_autoassign' in issues:
+        autoassign = expect_mapping(issues['project_autoassign'], '%s issues.project_autoassign' % (profile))
+        for field in ['name', 'column']:
+            expect(field in autoassign, '%s issues.project_autoassign needs a %s.', profile, field)
+        project_autoassign = ProjectAutoassignPolicy(
+            organization=bool(autoassign.get('organization', False)),
+            repository=autoassign.get('repository', None),
+            name=autoassign['name'],
+            column=autoassign['column'],
+        )
+    return IssuesPolicy(auto_label=tuple(auto_label), project_autoassign=project_autoassign)
+
+
+def compile_security(settings, profile):
+    if 'dependency_security' not in settings:
+        return None
+    security = expect_mapping(settings['dependency_security'], '%s dependency_security' % (profile))
+    return SecurityPolicy(
+        alerts=expect_bool(security.get('alerts'), '%s dependency_security.alerts' % (profile)),
+        automatic_fixes=expect_bool(security.get('automatic_fixes'), '%s dependency_security.automatic_fixes' % (profile)),
+    )
+
+
+def compile_repository(profile, settings):
+    branches = expect_mapping(settings.get('branches'), '%s branches' % (profile))
+    return RepositoryPolicy(
+        profile=profile,
+        features=compile_features(settings, profile),
+        merges=compile_merges(settings, profile),
+        branches=MappingProxyType(OrderedDict(
+            (name, compile_branch(name, branch, profile)) for name, branch in branches.items())),
+        teams=compile_teams(settings, profile),
+        teams_clean=bool(settings.get('teams_clean', False)),
+        issues=compile_issues(settings, profile),
+        dependency_security=compile_security(settings, profile),
+        delete_branch_on_merge=settings.get('delete_branch_on_merge', None),
+    )
+
+
+def compile_label(label):
+    expect(isinstance(label, dict) and 'name' in label, 'Every label needs a name.')
+    return LabelPolicy(
+        name=label['name'],
+        color=str(label.get('color', DEFAULT_LABEL_COLOR)),
+        description=label.get('description', None),
+        old_name=label.get('old_name', None),
+        repos=frozenset(label.get('repos', [])),
+    )
+
+
+def resolve_profile(repositories, name, depth=MAX_EXTENDS_DEPTH):
+    '''Apply the extends chain of a profile, working on copies of the configuration.'''
+    settings = repositories[name]
+    if isinstance(settings, str):
+        settings = {'extends': settings}
+    settings = dict(expect_mapping(settings, 'repositories.%s' % (name)))
+    parent_name = settings.pop('extends', None)
+    if parent_name and depth > 0 and parent_name in repositories:
+        parent = resolve_profile(repositories, parent_name, depth - 1)
+        parent.update(settings)
+        settings = parent
+    return settings
+
+
+def convert_legacy(configuration):
+    '''Convert from the old style configuration to the current version'''
+    settings = {key: value for key, value in configuration.items() if key not in FEATURES + MERGES + ['labels']}
+    settings['features'] = {key: configuration[key] for key in FEATURES if key in configuration}
+    settings['merges'] = {key: configuration[key] for key in MERGES if key in configuration}
+    return settings
+
+
+def compile_organization(configuration):
+    expect(isinstance(configuration, dict), 'The organizer configuration must be a mapping.')
+    legacy = 'repositories' not in configuration
+    if legacy:
+        profiles = {'default': compile_repository('default', convert_legacy(configuration))}
+    else:
+        repositories = expect_mapping(configuration['repositories'], 'repositories')
+        profiles = {name: compile_repository(name, resolve_profile(repositories, name)) for name in repositories}
+    labels = configuration.get('labels', None) or []
+    expect(isinstance(labels, list), 'labels must be a list.')
+    labels = tuple(compile_label(label) for label in labels)
+
+    # Lookup tables so per repository decisions do not scan the whole configuration.
+    repository_labels = {}
+    for label in labels:
+        for repository in label.repos:
+            repository_labels.setdefault(repository, set()).add(label.name)
+    return OrganizationPolicy(
+        version=config_version(configuration),
+        legacy=legacy,
+        profiles=MappingProxyType(profiles),
+        labels=labels,
+        labels_clean=bool(configuration.get('labels_clean', False)),
+        exclude_repositories=frozenset(configuration.get('exclude_repositories', None) or []),
+        exclude_forks=bool(configuration.get('exclude_forks', False)),
+        topics_for_assignment=bool(configuration.get('topics_for_assignment', True)),
+        topic_profiles=MappingProxyType({} if legacy else {'gho-%s' % (name): name for name in profiles}),
+        repository_profiles=MappingProxyType({} if legacy else {name: name for name in profiles if name != 'default'}),
+        repository_labels=MappingProxyType({name: frozenset(names) for name, names in repository_labels.items()}),
+    )
+
+
+_compiled = OrderedDict()
+
+
+def get_policy(configuration):
+    '''Compile a configuration, reusing the compiled policy for versions we have already seen.'''
+    version = config_version(configuration)
+    if version in _compiled:
+        _compiled.move_to_end(version)
+        return _compiled[version]
+    policy = compile_organization(configuration)
+    _compiled[version] = policy
+    while len(_compiled) > COMPILED_VERSIONS:
+        _compiled.popitem(last=False)
+    return policy
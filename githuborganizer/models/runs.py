@@ -0,0 +1,172 @@
+'''Persistent records of organization runs so an interrupted run picks up where it stopped.
+
+A run belongs to an organization and a configuration version. It keeps a cursor into the
+repository listing and the state of each aspect (settings, labels, ...) of each repository. When a
+run is restarted under the same configuration version it resumes, skipping everything that was
+already done. Aspects handed to another task are only queued until that task marks them done, so
+a resumed run hands out again whatever was lost with a worker. A changed configuration or a finished run starts a new one.
+
+Large organizations are listed a page at a time by separate shard tasks. Each page of a run is
+claimed by exactly one task, so a duplicated shard message or a second trigger of the same run
+does not list and reconcile the page again. The run keeps the pages that were handed to a shard
+and not yet finished, and is only finished once the last page has been listed and none are left,
+so a slow or redelivered shard for an earlier page still counts.
+'''
+import time
+import uuid
+from githuborganizer.models.policy import config_version
+from githuborganizer.services import state
+
+
+RUNS = 'organization_runs'
+ASPECTS = 'organization_run_aspects'
+PAGES = 'organization_run_pages'
+RUN_EXPIRE = 7 * 24 * 60 * 60 # One week
+PAGE_CLAIM_EXPIRE = 60 * 60 # Pages claimed by a shard that died are freed after an hour.
+
+QUEUED = 'queued'
+DONE = 'done'
+
+
+class OrganizationRun:
+
+    def __repr__(self):
+        return 'OrganizerRun %s %s' % (self.organization, self.run_id)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __init__(self, organization, configuration):
+        self.organization = organization
+        self.config_version = config_version(configuration)
+        record = state.get(RUNS, organization)
+        if record and record['status'] == 'running' and record['config_version'] == self.config_version:
+            self.record = record
+            self.resumed = True
+        else:
+            if record:
+                state.clear(ASPECTS, '%s/' % (organization,))
+                state.clear(PAGES, '%s/' % (organization,))
+            self.record = {
+                'run_id': uuid.uuid4().hex,
+                'config_version': self.config_version,
+                'cursor': None,
+                'page_cursor': None,
+                'position': 0,
+                'status': 'running',
+                'started': time.time(),
+            }
+            self.resumed = False
+            self.save()
+
+    @property
+    def run_id(self):
+        return self.record['run_id']
+
+    @property
+    def cursor(self):
+        return self.record['cursor']
+
+    @property
+    def page_cursor(self):
+        '''The listing cursor of the page being worked on, None for the first page.'''
+        return self.record.get('page_cursor')
+
+    def save(self):
+        self.record['updated'] = time.time()
+        state.set(RUNS, self.organization, self.record, expire=RUN_EXPIRE)
+
+    def reload(self):
+        '''Pick up changes the run's other shards stored.'''
+        record = state.get(RUNS, self.organization)
+        if record and record['run_id'] == self.run_id:
+            self.record = record
+
+    def update(self, position=0, **changes):
+        '''Change fields of the stored record, which the run's other shards may be updating too.'''
+        with state.transaction():
+            self.reload()
+            self.record.update(changes)
+            self.record['position'] += position
+            self.save()
+
+    def aspect_key(self, repository, aspect):
+        return '%s/%s/%s' % (self.organization, repository, aspect)
+
+    def is_complete(self, repository, aspect, queued=False):
+        '''Whether the aspect was done in this run.
+
+        Queued aspects are not, their task may be lost, unless queued is True: a task continuing
+        a page of this run knows the aspects it finds queued were handed off moments ago.
+        '''
+        aspect_state = state.get(ASPECTS, self.aspect_key(repository, aspect))
+        if not aspect_state or aspect_state['status'] not in ([DONE, QUEUED] if queued else [DONE]):
+            return False
+        return aspect_state['run_id'] == self.run_id and aspect_state['config_version'] == self.config_version
+
+    def mark(self, repository, aspect, status):
+        state.set(ASPECTS, self.aspect_key(repository, aspect), {
+            'run_id': self.run_id,
+            'config_version': self.config_version,
+            'status': status,
+        }, expire=RUN_EXPIRE)
+
+    def advance(self, repository):
+        self.update(cursor=repository, position=1)
+
+    def claim_page(self, page_cursor, owner):
+        '''Claim a page of the listing for one task. A redelivered task keeps its claim.'''
+        key = '%s/%s/%s' % (self.organization, self.run_id, page_cursor or '')
+        return state.acquire(PAGES, key, owner, PAGE_CLAIM_EXPIRE)
+
+    def release_page(self, page_cursor, owner):
+        state.release(PAGES, '%s/%s/%s' % (self.organization, self.run_id, page_cursor or ''), owner)
+
+    def advance_page(self, page_cursor):
+        self.update(page_cursor=page_cursor)
+
+    def open_page(self, page_cursor):
+        '''Record a page as handed to a shard. Opening a page twice keeps one entry.'''
+        with state.transaction():
+            self.reload()
+            pages = self.record.setdefault('open_pages', [])
+            if (page_cursor or '') not in pages:
+                pages.append(page_cursor or '')
+            self.save()
+
+    def get_open_pages(self):
+        self.reload()
+        return [page_cursor or None for page_cursor in self.record.get('open_pages', [])]
+
+    def is_page_open(self, page_cursor):
+        self.reload()
+        return (page_cursor or '') in self.record.get('open_pages', [])
+
+    def close_page(self, page_cursor, last=False):
+        '''Record a page as done, returning True when it was the run's last outstanding page.'''
+        with state.transaction():
+            self.reload()
+            pages = self.record.setdefault('open_pages', [])
+            if (page_cursor or '') in pages:
+                pages.remove(page_cursor or '')
+            if last:
+                self.record['listed'] = True
+            self.save()
+            return bool(self.record.get('listed')) and not pages
+
+    def finish(self):
+        self.update(status='finished', finished=time.time())
+
+
+def complete(organization, repository, aspect):
+    '''Mark an aspect a run queued as done, from the task that did the work.'''
+    key = '%s/%s/%s' % (organization, repository, aspect)
+    with state.transaction():
+        aspect_state = state.get(ASPECTS, key)
+        if aspect_state and aspect_state['status'] == QUEUED:
+            aspect_state['status'] = DONE
+            state.set(ASPECTS, key, aspect_state, expire=RUN_EXPIRE)
+
+
+def get_run(organization):
+    return state.get(RUNS, organization)
@@ -0,0 +1,75 @@
+'''Compact, serializable copies of the repository and issue state found in webhook payloads.
+
+Snapshots are plain dictionaries so they survive the trip through the celery broker. The models
+read from them instead of calling the API, and fall back to a fetch when a field is missing or the
+snapshot is older than MAX_AGE.
+'''
+import time
+
+MAX_AGE = 5 * 60 # Five minutes
+
+REPOSITORY_FIELDS = [
+    'id',
+    'node_id',
+    'name',
+    'full_name',
+    'fork',
+    'archived',
+    'default_branch',
+    'topics',
+    'has_issues',
+    'has_wiki',
+    'has_downloads',
+    'has_projects',
+    'allow_rebase_merge',
+    'allow_squash_merge',
+    'allow_merge_commit',
+    'pushed_at',
+    'updated_at',
+]
+
+ISSUE_FIELDS = [
+    'id',
+    'node_id',
+    'number',
+    'state',
+    'labels',
+    'updated_at',
+]
+
+
+def repository_snapshot(data):
+    snapshot = {field: data[field] for field in REPOSITORY_FIELDS if field in data}
+    snapshot['captured_at'] = time.time()
+    return snapshot
+
+
+def issue_snapshot(data):
+    snapshot = {field: data[field] for field in ISSUE_FIELDS if field in data}
+    if 'labels' in snapshot:
+        snapshot['labels'] = [label['name'] for label in snapshot['labels']]
+    snapshot['captured_at'] = time.time()
+    return snapshot
+
+
+def is_fresh(snapshot, max_age=MAX_AGE):
+    if not snapshot:
+        return False
+    return time.time() - snapshot.get('captured_at', 0) <= max_age
+
+
+def get_field(snapshot, field, max_age=MAX_AGE):
+    '''Raises KeyError when the field has to be fetched from the API instead.'''
+    if not is_fresh(snapshot, max_age):
+        raise KeyError(field)
+    return snapshot[field]
+
+
+def matches(snapshot, values, max_age=MAX_AGE):
+    '''True only when the snapshot proves every value is already set.'''
+    if not is_fresh(snapshot, max_age):
+        return False
+    for field, value in values.items():
+        if field not in snapshot or snapshot[field] != value:
+            return False
+    return True
@@ -0,0 +1,55 @@
+'''Per repository high water marks of the issues a backfill has already handled.
+
+Issue backfills (project autoassignment, auto labels) used to scan every open issue on every run.
+Each backfill now records the `updatedAt` of the last issue it finished for a repository and the
+next run only asks GitHub for issues updated since then, so catching up after missed webhooks
+costs a page or two. A watermark only moves forward, and only past issues that were handled.
+'''
+from githuborganizer.services import state
+
+
+WATERMARKS = 'issue_watermarks'
+
+ASSIGN = 'assign'
+LABEL = 'label'
+
+
+def watermark_key(organization, repository, purpose):
+    return '%s/%s/%s' % (organization, repository, purpose)
+
+
+def get_watermark(organization, repository, purpose):
+    '''The ISO 8601 updatedAt of the last handled issue, or None when everything needs a look.'''
+    return state.get(WATERMARKS, watermark_key(organization, repository, purpose))
+
+
+def advance(organization, repository, purpose, updated_at):
+    '''Move the watermark up to updated_at. Returns False if it was already past it.'''
+    if not updated_at:
+        return False
+    key = watermark_key(organization, repository, purpose)
+    with state.transaction():
+        current = state.get(WATERMARKS, key)
+        # ISO 8601 timestamps in UTC sort the same as the times they represent.
+        if current is not None and current >= updated_at:
+            return False
+        state.set(WATERMARKS, key, updated_at)
+    return True
+
+
+def handled_until(issues, handled):
+    '''The updatedAt the watermark can move to: that of the last issue before the first failure.
+
+    Issues must be in updatedAt order. `handled` is a list of booleans, one per issue.
+    '''
+    updated_at = None
+    for issue, success in zip(issues, handled):
+        if not success:
+            break
+        updated_at = issue['updated_at']
+    return updated_at
+
+
+def reset(organization, repository=None):
+    prefix = '%s/%s/' % (organization, repository) if repository else '%s/' % (organization,)
+    state.clear(WATERMARKS, prefix)
@@ -0,0 +1,112 @@
+'''Fair scheduling of background work across installations.
+
+Bulk work is not sent straight to celery. Each installation (keyed by organization name) gets its
+own logical queue in the state store, and `dispatch` drains those queues with deficit round robin:
+on every pass a tenant earns its weight in credit and spends one credit per task sent. A tenant
+never has more than INSTALLATION_CONCURRENCY tasks in flight, so a huge organization can not
+monopolize the workers or burn through its rate limit while small organizations wait.
+'''
+from celery.signals import task_postrun
+from celery.utils import uuid
+from githuborganizer import celery, CONFIG, lanes
+from githuborganizer.services import state
+
+
+INFLIGHT = 'scheduler_inflight'
+INFLIGHT_TASKS = 'scheduler_inflight_tasks'
+DEFICITS = 'scheduler_deficit'
+LOCKS = 'scheduler_lock'
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_WEIGHT = 1.0
+DISPATCH_LIMIT = 200
+INFLIGHT_EXPIRE = 60 * 60 # Slots of tasks that never report back are freed after an hour.
+DISPATCH_LOCK_EXPIRE = 60
+
+
+def get_concurrency():
+    return int(CONFIG.get('INSTALLATION_CONCURRENCY', DEFAULT_CONCURRENCY))
+
+
+def get_weights():
+    '''INSTALLATION_WEIGHTS is a comma separated list such as "bigorg=0.5,smallorg=2".'''
+    weights = {}
+    for entry in CONFIG.get('INSTALLATION_WEIGHTS', '').split(','):
+        if '=' not in entry:
+            continue
+        tenant, weight = entry.split('=', 1)
+        weights[tenant.strip()] = float(weight)
+    return weights
+
+
+def enqueue(tenant, task, *args, **kwargs):
+    state.push(tenant, {'task': task.name, 'args': list(args), 'kwargs': kwargs})
+
+
+def inflight(tenant):
+    return state.count(INFLIGHT, '%s/' % (tenant,))
+
+
+def dispatch(limit=DISPATCH_LIMIT):
+    owner = uuid()
+    if not state.acquire(LOCKS, 'dispatch', owner, DISPATCH_LOCK_EXPIRE):
+        # Another process is already dispatching and will pick up our work.
+        return 0
+    try:
+        return dispatch_tenants(limit)
+    finally:
+        state.release(LOCKS, 'dispatch', owner)
+
+
+def dispatch_tenants(limit):
+    concurrency = get_concurrency()
+    weights = get_weights()
+    dispatched = 0
+    while dispatched < limit:
+        progress = False
+        for tenant in state.queued_tenants():
+            available = concurrency - inflight(tenant)
+            if available <= 0:
+                # Blocked tenants do not bank credit while they wait.
+                continue
+            deficit = state.get(DEFICITS, tenant, 0) + weights.get(tenant, DEFAULT_WEIGHT)
+            while deficit >= 1 and available > 0 and dispatched < limit:
+                payload = state.pop(tenant)
+                if not payload:
+                    deficit = 0
+                    break
+                send(tenant, payload)
+                deficit -= 1
+                available -= 1
+                dispatched += 1
+                progress = True
+            state.set(DEFICITS, tenant, deficit)
+        if not progress:
+            break
+    return dispatched
+
+
+def send(tenant, payload):
+    task_id = uuid()
+    # Record the slot before sending so a fast task can not finish before we count it.
+    state.set(INFLIGHT, '%s/%s' % (tenant, task_id), payload['task'], expire=INFLIGHT_EXPIRE)
+    state.set(INFLIGHT_TASKS, task_id, tenant, expire=INFLIGHT_EXPIRE)
+    # Scheduled work is sweep work, whatever lane its task normally uses.
+    celery.send_task(payload['task'], args=payload['args'], kwargs=payload['kwargs'], task_id=task_id, queue=lanes.BULK)
+
+
+@task_postrun.connect
+def release_slot(task_id=None, **kwargs):
+    tenant = state.get(INFLIGHT_TASKS, task_id)
+    if tenant is None:
+        return
+    state.delete(INFLIGHT, '%s/%s' % (tenant, task_id))
+    state.delete(INFLIGHT_TASKS, task_id)
+    # A slot just opened up, so fill it without waiting for the periodic dispatch.
+    dispatch()
+
+
+def get_status():
+    queued = state.queued_tenants()
+    tenants = set(queued) | set(tenant for _, tenant in state.items(INFLIGHT_TASKS))
+    return {tenant: {'queued': queued.get(tenant, 0), 'inflight': inflight(tenant)} for tenant in sorted(tenants)}
@@ -0,0 +1,97 @@
+'''Pack independent GraphQL mutations into as few requests as possible.
+
+Each operation becomes an aliased field (`op0`, `op1`, ...) of a single mutation document with its
+own input variable. The response is split back into one result per operation, so a failure only
+marks the operation that failed. Batches go through the installation's write throttle like any
+other write and may be deferred as a whole when rate limited.
+'''
+from githuborganizer import CONFIG
+from githuborganizer.services import throttle
+
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+DEFAULT_BATCH_SIZE = 20
+
+# Writes planned for a single repository or organization are batched once there are more than this.
+BATCH_THRESHOLD = 3
+
+DEFERRED = 'deferred'
+
+
+def get_batch_size():
+    return int(CONFIG.get('GRAPHQL_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+
+
+def should_batch(operations):
+    return len(operations) > BATCH_THRESHOLD
+
+
+class MutationError(Exception):
+    pass
+
+
+class MutationBatch:
+
+    def __repr__(self):
+        return 'OrganizerMutationBatch %s operations' % len(self.operations)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __init__(self, installation, batch_size=None, accepts=False):
+        self.installation = installation
+        self.batch_size = batch_size or get_batch_size()
+        self.accepts = accepts
+        self.operations = []
+
+    def add(self, mutation, mutation_input, fields='clientMutationId'):
+        self.operations.append((mutation, mutation_input, fields))
+        return len(self.operations) - 1
+
+    def execute(self):
+        '''Run every operation and return a result per operation, in order.
+
+        A result is the mutation's data, a MutationError when that operation failed, or DEFERRED
+        when its batch was rate limited and queued for a retry.
+        '''
+        results = []
+        for start in range(0, len(self.operations), self.batch_size):
+            results += self.execute_batch(self.operations[start:start + self.batch_size])
+        self.operations = []
+        return results
+
+    def execute_batch(self, operations):
+        declarations = []
+        fields = []
+        variables = {}
+        for index, (mutation, mutation_input, selection) in enumerate(operations):
+            input_type = '%s%sInput' % (mutation[0].upper(), mutation[1:])
+            declarations.append('$input%s: %s!' % (index, input_type))
+            fields.append('op%s: %s(input: $input%s) { %s }' % (index, mutation, index, selection))
+            variables['input%s' % index] = mutation_input
+        payload = {
+            'query': 'mutation(%s) {\n%s\n}' % (', '.join(declarations), '\n'.join(fields)),
+            'variables': variables,
+        }
+        with throttle.tracking() as writes:
+            response = self.installation.write('post', GRAPHQL_URL, payload, self.accepts)
+        if not response and writes.given_up:
+            return [MutationError('Gave up after %s rate limited attempts' % (throttle.MAX_ATTEMPTS,))] * len(operations)
+        if not response:
+            return [DEFERRED] * len(operations)
+
+        errors = {}
+        for error in response.get('errors', []):
+            path = error.get('path') or ['']
+            errors.setdefault(path[0], []).append(error.get('message', 'Unknown error'))
+        data = response.get('data') or {}
+
+        results = []
+        for index in range(len(operations)):
+            alias = 'op%s' % index
+            if alias in errors or data.get(alias) is None:
+                messages = errors.get(alias) or [error.get('message', 'Unknown error') for error in response.get('errors', [])]
+                results.append(MutationError('; '.join(messages)))
+            else:
+                results.append(data[alias])
+        return results
@@ -1,28 +1,58 @@
-import base64
-import datetime
-from githuborganizer import config
-import github3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from githuborganizer import CONFIG, Lazy
+from githuborganizer.services import singleflight, throttle, timeouts, tracing
 from github3apps import GithubApp, GithubAppInstall
-import json
+from itertools import islice
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 import requests
-import yaml
 import os
+import threading
+
+WRITE_VERBS = ['post', 'put', 'patch', 'delete']
+DEFAULT_PAGE_CONCURRENCY = 4
+MISSING = 'missing'
+
 
 class GithubOrganizerApp(GithubApp):
 
+    def request(self, url, method='GET'):
+        '''GithubApp.request, with timeouts for the app's own calls such as fetching tokens.'''
+        headers = {
+            'Authorization': 'Bearer %s' % (self.get_jwt(),),
+            'Accept': 'application/vnd.github.machine-man-preview+json',
+            'User-Agent': self.useragent
+        }
+        request_url = url if url.startswith('https') else 'https://api.github.com/%s' % (url,)
+        response = timeouts.request('token', method, request_url, headers=headers)
+        response.raise_for_status()
+        retobj = response.json()
+        nextpage = get_next(response)
+        if nextpage:
+            retobj += self.request(nextpage)
+        return retobj
+
     def get_installation(self, installation_id):
         return GithubOrganizerAppInstall(self, installation_id)
 
     def get_org_installation(self, organization):
+        return self.get_installation(self.get_org_installation_id(organization))
+
+    @singleflight.shared('installation')
+    def get_org_installation_id(self, organization):
         url = 'orgs/%s/installation' % (organization)
         res = self.request(url)
-        return self.get_installation(res['id'])
+        return res['id']
 
 
 class GithubOrganizerAppInstall(GithubAppInstall):
 
+    def get_auth_token(self):
+        with tracing.span('github token', installation=self.installid):
+            return super().get_auth_token()
+
     def get_github3_client(self):
-        client = super().get_github3_client()
+        client = timeouts.configure_github3(super().get_github3_client())
         client.app = self
         return client
 
@@ -37,41 +67,153 @@ class GithubOrganizerAppInstall(GithubAppInstall):
     def graphql(self, payload):
         url = 'https://api.github.com/graphql'
         headers = {'Authorization': 'token %s' % self.get_auth_token()}
-        r = requests.post(url=url, json=payload, headers=headers)
-        r.raise_for_status()
+        with tracing.span('github graphql') as api_span:
+            r = timeouts.request('graphql', 'post', url, json=payload, headers=headers)
+            api_span.set('status', r.status_code)
+            r.raise_for_status()
         return r.json()
 
-    def rest(self, verb, endpoint=False, payload=False, accepts=False, url=False):
+    def rest(self, verb, endpoint=False, payload=False, accepts=False, url=False, attempt=0):
+        if not url:
+            url = 'https://api.github.com/%s' % endpoint
+        if verb.lower() in WRITE_VERBS:
+            return self.write(verb, url, payload, accepts, attempt)
+        return self.send(verb, url, payload, accepts)
+
+    def write(self, verb, url, payload=False, accepts=False, attempt=0):
+        '''Send a write through the installation's adaptive window, deferring it if rate limited.'''
+        key = str(self.installid)
+        try:
+            slot = throttle.acquire(key)
+        except throttle.WriteThrottled as error:
+            return throttle.defer(self.installid, verb, url, payload, accepts, error.retry_after, attempt)
+        retry_after = None
+        succeeded = False
+        # Whatever goes wrong (connection errors, timeouts, the task's time limit) the slot is
+        # given back, or the installation's window would shrink until the slots expire.
+        try:
+            try:
+                results = self.send(verb, url, payload, accepts)
+                succeeded = True
+                return results
+            except requests.HTTPError as error:
+                retry_after = throttle.get_retry_after(error.response)
+                if retry_after is None:
+                    raise
+        finally:
+            throttle.release(key, slot, retry_after, succeeded)
+        return throttle.defer(self.installid, verb, url, payload, accepts, retry_after, attempt)
+
+    def paginate(self, endpoint=False, accepts=False, url=False):
+        '''Yield the items of a listing as each page arrives instead of loading every page first.'''
+        if not url:
+            url = 'https://api.github.com/%s' % endpoint
+        r = self.send_request('get', url, accepts=accepts)
+        for item in r.json():
+            yield item
+        for page in self.remaining_pages(r, accepts):
+            for item in page:
+                yield item
+
+    def remaining_pages(self, r, accepts=False):
+        '''Yield the JSON of every page after the response r, in order.
+
+        When GitHub tells us the last page the rest are fetched in parallel, sharing the
+        installation's PAGE_CONCURRENCY limit with every other listing in this process. Only
+        PAGE_CONCURRENCY pages are requested ahead of the one being yielded, so a caller that
+        stops early does not leave every page of a large listing fetched or queued.
+        '''
+        next = get_next(r)
+        if not next:
+            return
+        last = get_last(r)
+        urls = page_urls(next, last) if last else None
+        if not urls:
+            # Without a last link the pages have to be followed one by one.
+            while next:
+                r = self.send_request('get', next, accepts=accepts)
+                yield r.json()
+                next = get_next(r)
+            return
+        limit = get_page_limit(self.installid)
+        parent = tracing.current_span()
+
+        def fetch(url):
+            with limit, tracing.continued(parent):
+                return self.send_request('get', url, accepts=accepts).json()
+
+        window = get_page_concurrency()
+        with ThreadPoolExecutor(max_workers=min(len(urls), window)) as pool:
+            urls = iter(urls)
+            pending = deque(pool.submit(fetch, url) for url in islice(urls, window))
+            while pending:
+                page = pending.popleft().result()
+                # Start the next page before handing this one over.
+                for url in islice(urls, 1):
+                    pending.append(pool.submit(fetch, url))
+                yield page
+
+    def get_etag(self, url, etag=None, accepts=False):
+        '''The ETag of a resource, MISSING if it does not exist.
+
+        Asked with If-None-Match, so when the resource did not change GitHub answers 304, which
+        does not count against the rate limit.
+        '''
+        try:
+            r = self.send_request('get', url, accepts=accepts, etag=etag if etag != MISSING else None)
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                return MISSING
+            raise
+        if r.status_code == 304:
+            return etag
+        return r.headers.get('ETag')
+
+    def send_request(self, verb, url, payload=False, accepts=False, etag=None):
         accepts_all = ['application/json', 'application/vnd.github.v3+json']
         if accepts:
             if isinstance(accepts, str):
                 accepts_all.append(accepts)
             else:
                 accepts_all += accepts
-        if not url:
-            url = 'https://api.github.com/%s' % endpoint
         headers = {
             'Authorization': 'token %s' % self.get_auth_token(),
             'Accept': ', '.join(accepts_all)
             }
-        if payload:
-            r = requests.request(verb, url, headers=headers, json=payload)
-        else:
-            r = requests.request(verb, url, headers=headers)
-        r.raise_for_status()
+        if etag:
+            headers['If-None-Match'] = etag
+        with tracing.span('github %s' % (verb.lower()), url=url) as api_span:
+            if payload:
+                r = timeouts.request('rest', verb, url, headers=headers, json=payload)
+            else:
+                r = timeouts.request('rest', verb, url, headers=headers)
+            api_span.set('status', r.status_code)
+            r.raise_for_status()
+        return r
+
+    def send(self, verb, url, payload=False, accepts=False):
+        r = self.send_request(verb, url, payload, accepts)
         if len(r.content) <= 0:
             return True
 
-        next = get_next(r)
-        if next:
+        if get_next(r):
             results = r.json()
-            results.append(self.rest('get', url=next, accepts=accepts))
+            for page in self.remaining_pages(r, accepts):
+                results += page
             return results
 
         return r.json()
 
 
 def get_next(r):
+    return get_link(r, 'next')
+
+
+def get_last(r):
+    return get_link(r, 'last')
+
+
+def get_link(r, rel):
     link = r.headers.get('link', False)
     if not link:
         return False
@@ -80,17 +222,61 @@ def get_next(r):
     links = link.split(',')
 
     for link in links:
-        # If there is a 'next' link return the URL between the angle brackets, or None
-        if 'rel="next"' in link:
+        # If there is a matching link return the URL between the angle brackets, or None
+        if 'rel="%s"' % (rel) in link:
             return link[link.find("<")+1:link.find(">")]
     return False
 
 
-ghapp = GithubOrganizerApp(os.environ['GITHUB_APP_ID'], os.environ['GITHUB_PRIVATE_KEY'])
+def get_page_number(url):
+    pages = parse_qs(urlparse(url).query).get('page')
+    if not pages or not pages[0].isdigit():
+        return None
+    return int(pages[0])
+
+
+def page_urls(next, last):
+    '''Every page URL from next to last, or None when they are not numbered pages.'''
+    first_page = get_page_number(next)
+    last_page = get_page_number(last)
+    if first_page is None or last_page is None or last_page < first_page:
+        return None
+    parts = urlparse(next)
+    query = parse_qs(parts.query)
+    urls = []
+    for page in range(first_page, last_page + 1):
+        query['page'] = [str(page)]
+        urls.append(urlunparse(parts._replace(query=urlencode(query, doseq=True))))
+    return urls
+
+
+def get_page_concurrency():
+    return int(CONFIG.get('PAGE_CONCURRENCY', DEFAULT_PAGE_CONCURRENCY))
+
+
+_page_limits = {}
+_page_limits_lock = threading.Lock()
+
+
+def get_page_limit(installation_id):
+    with _page_limits_lock:
+        if installation_id not in _page_limits:
+            _page_limits[installation_id] = threading.BoundedSemaphore(get_page_concurrency())
+        return _page_limits[installation_id]
+
+
+# Built on first use so importing this module does not need the app credentials.
+ghapp = Lazy(lambda: GithubOrganizerApp(os.environ['GITHUB_APP_ID'], os.environ['GITHUB_PRIVATE_KEY']))
+
 
+def get_installation(organization, installation_id=False):
+    '''Use the installation id from a webhook when we have it to skip the org lookup.'''
+    if installation_id:
+        return ghapp.get_installation(installation_id)
+    return ghapp.get_org_installation(organization)
 
 def get_installation_client(installation_id):
-    return ghapp.get_installation(install_id).get_github3_client()
+    return ghapp.get_installation(installation_id).get_github3_client()
 
 def get_organization_client(organization):
     return ghapp.get_org_installation(organization).get_github3_client()
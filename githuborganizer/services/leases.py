@@ -0,0 +1,173 @@
+'''Leases that keep two workers from reconciling the same thing at the same time.
+
+A periodic sweep, a webhook and the CLI can all ask for the same repository to be reconciled at
+once. Reconcile tasks take a lease on (organization, repository, aspect) from the state store
+first. A task that finds the lease held does not repeat the work: it leaves a request behind and
+returns, and the holder runs one more pass before letting go if a request came in while it was
+working, so changes that triggered the later task are still picked up. Leases expire on their own
+if the holder dies. Contention and skips are counted per organization and aspect.
+'''
+import time
+import uuid
+from githuborganizer.services import state
+
+
+LEASES = 'reconcile_leases'
+REQUESTS = 'reconcile_requests'
+STATS = 'reconcile_stats'
+
+LEASE_EXPIRE = 15 * 60 # Fifteen minutes
+LEASE_GRACE = 60
+MAX_PASSES = 3
+
+
+class Lease:
+
+    def __repr__(self):
+        return 'OrganizerLease %s' % self.key
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __init__(self, organization, repository, aspect, expire=None):
+        self.organization = organization
+        self.repository = repository
+        self.aspect = aspect
+        self.key = '%s/%s/%s' % (organization, repository, aspect)
+        self.owner = uuid.uuid4().hex
+        self.expire = expire or get_expire()
+        self.acquired = False
+        self.passes = 0
+        self.requeue = False
+
+    def __enter__(self):
+        # Taking the lease and leaving a request are one step, so the holder can not let go in
+        # between and miss the request.
+        with state.transaction():
+            holder = state.get(LEASES, self.key)
+            self.acquired = holder is None or holder == self.owner
+            if self.acquired:
+                state.set(LEASES, self.key, self.owner, expire=self.expire)
+                # Requests left before we started are covered by this pass.
+                state.delete(REQUESTS, self.key)
+            else:
+                state.set(REQUESTS, self.key, time.time(), expire=self.expire)
+        if not self.acquired:
+            record(self.organization, self.aspect, 'skipped')
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.acquired:
+            # Only reached with the lease still held when a pass failed.
+            self.requeue = self.let_go()
+        if self.requeue:
+            requeue(self.key)
+        return False
+
+    def let_go(self):
+        '''Release the lease, returning True if requests came in that nobody will now handle.'''
+        with state.transaction():
+            pending = self.release_locked()
+        return pending
+
+    def release_locked(self):
+        pending = state.get(REQUESTS, self.key) is not None
+        state.delete(REQUESTS, self.key)
+        if state.get(LEASES, self.key) == self.owner:
+            state.delete(LEASES, self.key)
+        self.acquired = False
+        return pending
+
+    def passes_needed(self):
+        '''Yield once per pass: the first and one more for each batch of requests that came in.
+
+        Checking for requests and releasing the lease happen in one transaction, so a request is
+        either seen here or finds the lease free. Requests still coming in after MAX_PASSES are
+        handed to a new task (see `requeue`).
+        '''
+        while True:
+            self.passes += 1
+            yield self.passes
+            with state.transaction():
+                pending = state.get(REQUESTS, self.key) is not None
+                again = pending and self.passes < MAX_PASSES
+                if again:
+                    state.delete(REQUESTS, self.key)
+                    state.set(LEASES, self.key, self.owner, expire=self.expire)
+                else:
+                    self.release_locked()
+            if not again:
+                self.requeue = pending
+                return
+            record(self.organization, self.aspect, 'coalesced')
+
+
+class RepositoryLeases:
+    '''Leases on one aspect of many repositories, for work that handles them together.
+
+    Repositories whose lease another task holds are left to it, with a request so it takes one
+    more pass. Repositories asked for again while their lease was held here are listed in
+    `requested` once the block ends, for the caller to hand out again.
+    '''
+
+    def __init__(self, organization, repositories, aspect):
+        self.leases = [Lease(organization, repository, aspect) for repository in repositories]
+        self.acquired = set()
+        self.requested = []
+
+    def __enter__(self):
+        for lease in self.leases:
+            lease.__enter__()
+            if lease.acquired:
+                self.acquired.add(lease.repository)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        for lease in self.leases:
+            if lease.acquired and lease.let_go():
+                self.requested.append(lease.repository)
+        return False
+
+
+def get_expire():
+    '''Outlive the running task's hard time limit, so the lease can not lapse mid pass.'''
+    from celery import current_task
+    time_limit = getattr(current_task, 'time_limit', None) if current_task else None
+    if time_limit is None and current_task:
+        time_limit = current_task.app.conf.task_time_limit
+    return max(LEASE_EXPIRE, (time_limit or 0) + LEASE_GRACE)
+
+
+def requeue(key):
+    '''Send the running task again, without its snapshot, for requests it had no passes left for.'''
+    from celery import current_task
+    if not current_task or not current_task.request.id:
+        print('%s was asked for again while out of passes, the next sweep will pick it up.' % (key))
+        return
+    kwargs = {name: value for name, value in (current_task.request.kwargs or {}).items() if name != 'repository_snapshot'}
+    current_task.apply_async(current_task.request.args, kwargs)
+    print('%s was asked for again while out of passes, queued another reconcile.' % (key))
+
+
+def record(organization, aspect, outcome):
+    state.increment(STATS, '%s/%s/%s' % (organization, aspect.split(':', 1)[0], outcome))
+
+
+def get_stats(organization=None):
+    prefix = '%s/' % (organization,) if organization else ''
+    return dict(state.items(STATS, prefix))
+
+
+def reconcile(organization, repository, aspect, work, repository_snapshot=None):
+    '''Run work under the lease, returning False when someone else is already doing it.
+
+    Work is called with the repository snapshot on the first pass. Later passes were asked for
+    because something changed, so they get None and read the repository fresh.
+    '''
+    with Lease(organization, repository, aspect) as lease:
+        if not lease.acquired:
+            print('%s is already being reconciled, leaving it to the running task.' % (lease.key))
+            return False
+        for current_pass in lease.passes_needed():
+            work(repository_snapshot if current_pass == 1 else None)
+    return True
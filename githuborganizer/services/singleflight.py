@@ -0,0 +1,74 @@
+'''Collapse concurrent identical lookups into a single request.
+
+The model caches only help once a value is cached. When many tasks in one worker ask for the same
+cold value at once (the configuration, a project or column id, ...) every one of them would miss
+the cache and make the same API calls. Functions wrapped with `shared` let the first caller for a
+key do the work while the others wait for its result, or its exception. Every call that was served
+this way is counted, per lookup name, in the state store.
+'''
+import functools
+import threading
+from githuborganizer.services import state
+
+
+STATS = 'singleflight_saved'
+
+
+class Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        '''Run function once for everyone asking for key at the same time. Returns (result, shared).'''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result, False
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+_group = Group()
+
+
+def shared(name):
+    '''Decorate a lookup so concurrent calls with the same arguments share one request.'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = (name, tuple(str(arg) for arg in args), tuple(sorted((k, str(v)) for k, v in kwargs.items())))
+            result, was_shared = _group.do(key, function, *args, **kwargs)
+            if was_shared:
+                state.increment(STATS, name)
+            return result
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    return dict(state.items(STATS))
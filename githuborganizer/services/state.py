@@ -0,0 +1,160 @@
+'''Small SQLite backed store for state that has to be shared between worker processes.
+
+The cache (beaker) is fine for data we can lose at any time. Anything the scheduler or the tasks
+need to coordinate on lives here instead, in namespaced key/value rows and a simple task queue.
+
+Every process has to open the same database: point STATE_DATABASE of the web server and of every
+worker at one file on storage they share, such as a volume mounted into each container (see
+docker-compose.yaml). SQLite needs that storage to be local to one host, not a network filesystem.
+The default under /tmp is only shared by processes in the same container.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+from githuborganizer import CONFIG
+
+
+DEFAULT_PATH = '/tmp/gitorganizer/state.sqlite'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS kv (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        expires REAL,
+        PRIMARY KEY (namespace, key)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tenant TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        enqueued REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS queue_tenant ON queue (tenant, id)',
+]
+
+_local = threading.local()
+
+
+def get_connection():
+    path = CONFIG.get('STATE_DATABASE', DEFAULT_PATH)
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and getattr(_local, 'path', None) == path:
+        return connection
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    for statement in SCHEMA:
+        connection.execute(statement)
+    _local.connection = connection
+    _local.path = path
+    return connection
+
+
+class transaction:
+    '''Holds the database write lock so read-modify-write steps are atomic across processes.'''
+
+    def __enter__(self):
+        self.connection = get_connection()
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.connection.execute('ROLLBACK')
+        else:
+            self.connection.execute('COMMIT')
+
+
+def get(namespace, key, default=None):
+    row = get_connection().execute(
+        'SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)',
+        (namespace, key, time.time())).fetchone()
+    if row is None:
+        return default
+    return json.loads(row[0])
+
+
+def set(namespace, key, value, expire=None):
+    expires = time.time() + expire if expire else None
+    get_connection().execute(
+        'INSERT OR REPLACE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?)',
+        (namespace, key, json.dumps(value), expires))
+
+
+def delete(namespace, key):
+    get_connection().execute('DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, key))
+
+
+def items(namespace, prefix=''):
+    rows = get_connection().execute(
+        "SELECT key, value FROM kv WHERE namespace = ? AND key LIKE ? ESCAPE '\\' AND (expires IS NULL OR expires > ?) ORDER BY key",
+        (namespace, escape_like(prefix) + '%', time.time()))
+    for key, value in rows:
+        yield key, json.loads(value)
+
+
+def count(namespace, prefix=''):
+    row = get_connection().execute(
+        "SELECT COUNT(*) FROM kv WHERE namespace = ? AND key LIKE ? ESCAPE '\\' AND (expires IS NULL OR expires > ?)",
+        (namespace, escape_like(prefix) + '%', time.time())).fetchone()
+    return row[0]
+
+
+def clear(namespace, prefix=''):
+    get_connection().execute(
+        "DELETE FROM kv WHERE namespace = ? AND key LIKE ? ESCAPE '\\'",
+        (namespace, escape_like(prefix) + '%'))
+
+
+def increment(namespace, key, amount=1):
+    with transaction():
+        value = get(namespace, key, 0) + amount
+        set(namespace, key, value)
+    return value
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def push(tenant, payload):
+    get_connection().execute(
+        'INSERT INTO queue (tenant, payload, enqueued) VALUES (?, ?, ?)',
+        (tenant, json.dumps(payload), time.time()))
+
+
+def pop(tenant):
+    with transaction() as connection:
+        row = connection.execute(
+            'SELECT id, payload, enqueued FROM queue WHERE tenant = ? ORDER BY id LIMIT 1',
+            (tenant,)).fetchone()
+        if row is None:
+            return None
+        connection.execute('DELETE FROM queue WHERE id = ?', (row[0],))
+    payload = json.loads(row[1])
+    payload['enqueued'] = row[2]
+    return payload
+
+
+def queued_tenants():
+    rows = get_connection().execute('SELECT tenant, COUNT(*) FROM queue GROUP BY tenant ORDER BY tenant')
+    return {tenant: total for tenant, total in rows}
+
+
+def acquire(namespace, key, owner, expire):
+    '''Take a lock that expires on its own if the holder dies. Returns True when the lock is ours.'''
+    with transaction():
+        holder = get(namespace, key)
+        if holder is not None and holder != owner:
+            return False
+        set(namespace, key, owner, expire=expire)
+    return True
+
+
+def release(namespace, key, owner):
+    with transaction():
+        if get(namespace, key) == owner:
+            delete(namespace, key)
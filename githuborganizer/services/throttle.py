@@ -0,0 +1,153 @@
+'''Adaptive concurrency for GitHub writes, plus a retry queue for writes that were rate limited.
+
+GitHub's secondary rate limits punish bursts of content creating requests. Every write an
+installation makes takes a slot from a window shared through the state store. The window grows by
+one slot per window's worth of successful writes and halves whenever GitHub answers with a 403 or
+429 rate limit (AIMD), and a Retry-After pauses every writer for that installation. Writes that are
+rate limited, or would have to wait too long for a slot, go to an idempotent retry queue with
+exponential backoff. Only that one operation is retried later; the task carries on with the rest.
+'''
+import hashlib
+import json
+import threading
+import time
+import uuid
+from githuborganizer import CONFIG
+from githuborganizer.services import state
+
+
+WINDOWS = 'write_windows'
+SLOTS = 'write_slots'
+RETRIES = 'write_retries'
+
+MIN_LIMIT = 1.0
+START_LIMIT = 4.0
+SLOT_EXPIRE = 60 # Slots of writers that die without releasing them are freed after a minute.
+MAX_WAIT = 10 # Seconds a write waits for a slot before it is deferred to the retry queue.
+DEFAULT_RETRY_AFTER = 60
+MAX_ATTEMPTS = 8
+RETRY_EXPIRE = 7 * 24 * 60 * 60 # One week
+
+
+_local = threading.local()
+
+
+class tracking:
+    '''Counts the writes this thread deferred while the block ran, so callers can tell whether
+    everything they asked for really went out. Writes given up on count as deferred and given up.'''
+
+    def __enter__(self):
+        self.deferred = 0
+        self.given_up = 0
+        if not hasattr(_local, 'trackers'):
+            _local.trackers = []
+        _local.trackers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _local.trackers.remove(self)
+        return False
+
+
+class WriteThrottled(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__('Writes are throttled for %0.1f seconds.' % (retry_after))
+        self.retry_after = retry_after
+
+
+def get_max_limit():
+    return float(CONFIG.get('WRITE_CONCURRENCY', 10))
+
+
+def get_window(key):
+    return state.get(WINDOWS, key, {'limit': START_LIMIT, 'blocked_until': 0})
+
+
+def acquire(key, max_wait=MAX_WAIT):
+    '''Take a write slot for the installation, raising WriteThrottled if none frees up in time.'''
+    slot = '%s/%s' % (key, uuid.uuid4().hex)
+    deadline = time.time() + max_wait
+    while True:
+        with state.transaction():
+            window = get_window(key)
+            wait = window['blocked_until'] - time.time()
+            if wait <= 0 and state.count(SLOTS, '%s/' % (key)) < int(window['limit']):
+                state.set(SLOTS, slot, True, expire=SLOT_EXPIRE)
+                return slot
+        pause = min(max(wait, 0.25), 1)
+        if time.time() + max(wait, pause) > deadline:
+            raise WriteThrottled(max(wait, pause))
+        time.sleep(pause)
+
+
+def release(key, slot, retry_after=None, succeeded=True):
+    '''Give the slot back. Successful writes grow the window, rate limits shrink it.'''
+    with state.transaction():
+        state.delete(SLOTS, slot)
+        window = get_window(key)
+        if retry_after is None:
+            if not succeeded:
+                return
+            window['limit'] = min(get_max_limit(), window['limit'] + 1 / window['limit'])
+        else:
+            window['limit'] = max(MIN_LIMIT, window['limit'] / 2)
+            window['blocked_until'] = max(window['blocked_until'], time.time() + retry_after)
+        state.set(WINDOWS, key, window)
+
+
+def get_retry_after(response):
+    '''Seconds to wait if the response is a rate limit, otherwise None.'''
+    if response is None:
+        return None
+    if response.status_code not in [403, 429]:
+        return None
+    if 'Retry-After' in response.headers:
+        return float(response.headers['Retry-After'])
+    if response.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in response.headers:
+        return max(1.0, float(response.headers['X-RateLimit-Reset']) - time.time())
+    message = response.text.lower()
+    if response.status_code == 429 or 'secondary rate limit' in message or 'abuse' in message:
+        return DEFAULT_RETRY_AFTER
+    return None
+
+
+def operation_key(installation, verb, url, payload):
+    encoded = json.dumps([installation, verb.lower(), url, payload], sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def defer(installation, verb, url, payload, accepts, retry_after, attempt=0):
+    '''Queue a write to run again later. Queuing the same write twice only keeps one copy.'''
+    for tracker in getattr(_local, 'trackers', []):
+        tracker.deferred += 1
+        tracker.given_up += attempt >= MAX_ATTEMPTS
+    if attempt >= MAX_ATTEMPTS:
+        print('Giving up on %s %s after %s attempts.' % (verb.upper(), url, attempt))
+        return False
+    delay = max(retry_after, DEFAULT_RETRY_AFTER * (2 ** attempt))
+    print('Deferring %s %s for %0.0f seconds.' % (verb.upper(), url, delay))
+    state.set(RETRIES, operation_key(installation, verb, url, payload), {
+        'installation': installation,
+        'verb': verb,
+        'url': url,
+        'payload': payload,
+        'accepts': accepts,
+        'attempt': attempt + 1,
+        'next_attempt': time.time() + delay,
+    }, expire=RETRY_EXPIRE)
+    return False
+
+
+def pop_due():
+    '''Remove and return the deferred writes that are ready to run again.'''
+    now = time.time()
+    with state.transaction():
+        due = [(key, operation) for key, operation in state.items(RETRIES) if operation['next_attempt'] <= now]
+        for key, _ in due:
+            state.delete(RETRIES, key)
+    return [operation for _, operation in due]
+
+
+def pending():
+    return state.count(RETRIES)
@@ -0,0 +1,262 @@
+'''Bound how long any one GitHub call or task can hold a worker slot.
+
+Every call goes out with the connect and read timeouts of its endpoint class, and a total deadline
+for the whole exchange, since a server that trickles a byte at a time never trips the read
+timeout. REQUEST_TIMEOUTS overrides the defaults per class, such as "graphql=5/90/240,rest=5/30/90"
+(connect/read/total seconds). A watchdog thread reports calls still running past their deadline
+and cancels them by shutting their connection down; the caller then gets a CallTimeout, which is a
+requests.Timeout.
+
+Tasks get a soft time limit (TASK_SOFT_TIME_LIMIT, seconds) and a hard one a minute later. Tasks
+that checkpoint their progress catch the SoftTimeLimitExceeded and hand the rest to a new task.
+How long each task took, and which ones hit their limit, is kept in the state store.
+'''
+import socket
+import threading
+import time
+import requests
+from githuborganizer import CONFIG
+from githuborganizer.services import state
+
+
+DEFAULT_TIMEOUTS = {
+    'rest': (5.0, 30.0, 90.0),
+    'graphql': (5.0, 60.0, 180.0),
+    'token': (5.0, 15.0, 30.0),
+    'github3': (5.0, 30.0, None),
+}
+
+WATCHDOG_INTERVAL = 1.0
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_SOFT_TIME_LIMIT = 300
+HARD_LIMIT_GRACE = 60
+# Tasks that walk a whole organization in one go get this many times the limit.
+LONG_TASKS = {
+    'githuborganizer.tasks.github.process_installs': 4,
+    'githuborganizer.tasks.github.update_organization_teams': 6,
+    'githuborganizer.tasks.github.refresh_organization_mirror': 4,
+    'githuborganizer.tasks.github.assign_issues': 4,
+    'githuborganizer.tasks.github.label_issues': 4,
+    'githuborganizer.tasks.github.migrate_default_branches': 6,
+}
+
+# Upper bounds, in seconds, of the buckets task durations are counted in.
+BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, float('inf')]
+
+STUCK = 'stuck_calls'
+DURATIONS = 'task_durations'
+LIMITS = 'task_time_limits'
+
+
+class CallTimeout(requests.Timeout):
+    pass
+
+
+def get_timeouts(endpoint):
+    '''(connect, read, total) seconds for an endpoint class. A total of None means no deadline.'''
+    connect, read, total = DEFAULT_TIMEOUTS[endpoint]
+    for entry in CONFIG.get('REQUEST_TIMEOUTS', '').split(','):
+        if '=' not in entry:
+            continue
+        name, values = entry.split('=', 1)
+        if name.strip() != endpoint:
+            continue
+        values = [float(value) for value in values.split('/')]
+        connect, read = values[0], values[1] if len(values) > 1 else read
+        total = values[2] if len(values) > 2 else total
+    return connect, read, total
+
+
+class Call:
+
+    def __init__(self, endpoint, verb, url, total):
+        self.endpoint = endpoint
+        self.verb = verb
+        self.url = url
+        self.started = time.time()
+        self.deadline = self.started + total if total else None
+        self.response = None
+        self.cancelled = False
+
+    def overdue(self, now):
+        return self.deadline is not None and now > self.deadline
+
+    def cancel(self):
+        '''Cut off an overdue body, returning False while the headers are still on their way.'''
+        if self.response is None:
+            # The read timeout already bounds the wait for headers, and a response that makes it
+            # in time is still used. The next watchdog pass looks at the call again.
+            return False
+        self.cancelled = True
+        # Closing the response waits for the blocked read, shutting the socket down wakes it up.
+        sock = get_socket(self.response)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        return True
+
+
+def get_socket(response):
+    sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock is None:
+        # http.client lets go of the connection's socket when the server will close it, but the
+        # file the body is read from still has it.
+        fp = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    return sock
+
+
+lock = threading.Lock()
+inflight = set()
+watchdog = {'thread': None}
+
+
+def track(call):
+    with lock:
+        inflight.add(call)
+        if watchdog['thread'] is None:
+            watchdog['thread'] = threading.Thread(target=watch, name='request-watchdog', daemon=True)
+            watchdog['thread'].start()
+
+
+def untrack(call):
+    with lock:
+        inflight.discard(call)
+
+
+def watch():
+    while True:
+        time.sleep(WATCHDOG_INTERVAL)
+        now = time.time()
+        with lock:
+            overdue = [call for call in inflight if call.overdue(now) and not call.cancelled]
+        for call in overdue:
+            try:
+                if not call.cancel():
+                    continue
+            except Exception as e:
+                print('Unable to close %s: %s' % (call.url, e))
+            print('Cancelled %s %s after %0.1fs.' % (call.verb.upper(), call.url, now - call.started))
+            state.increment(STUCK, call.endpoint)
+
+
+def request(endpoint, verb, url, **kwargs):
+    '''requests.request with the endpoint's timeouts, watched until the whole body has arrived.'''
+    connect, read, total = get_timeouts(endpoint)
+    call = Call(endpoint, verb, url, total)
+    track(call)
+    try:
+        r = requests.request(verb, url, timeout=(connect, read), stream=True, **kwargs)
+        call.response = r
+        chunks = []
+        for chunk in r.iter_content(CHUNK_SIZE):
+            chunks.append(chunk)
+            if call.cancelled or call.overdue(time.time()):
+                call.cancelled = True
+                break
+        if call.cancelled:
+            r.close()
+            raise CallTimeout('%s %s took longer than %ss' % (verb.upper(), url, total))
+        # What Response.content would have read, so the response behaves as if not streamed.
+        r._content = b''.join(chunks)
+        r._content_consumed = True
+        return r
+    except CallTimeout:
+        raise
+    except Exception as error:
+        if call.cancelled:
+            raise CallTimeout('%s %s took longer than %ss' % (verb.upper(), url, total)) from error
+        raise
+    finally:
+        untrack(call)
+
+
+def configure_github3(client):
+    '''github3 keeps its own session, so it gets the github3 class's connect and read timeouts.'''
+    connect, read, _ = get_timeouts('github3')
+    client.session.default_connect_timeout = connect
+    client.session.default_read_timeout = read
+    return client
+
+
+def get_soft_time_limit():
+    return float(CONFIG.get('TASK_SOFT_TIME_LIMIT', DEFAULT_SOFT_TIME_LIMIT))
+
+
+def configure(app):
+    '''Set task time limits on a celery application and record how long tasks take.'''
+    from celery.signals import task_failure, task_postrun, task_prerun
+    soft = get_soft_time_limit()
+    app.conf.task_soft_time_limit = soft
+    app.conf.task_time_limit = soft + HARD_LIMIT_GRACE
+    app.conf.task_annotations = {
+        name: {'soft_time_limit': soft * factor, 'time_limit': soft * factor + HARD_LIMIT_GRACE}
+        for name, factor in LONG_TASKS.items()
+    }
+    task_prerun.connect(start_task, weak=False)
+    task_postrun.connect(finish_task, weak=False)
+    task_failure.connect(record_limit, weak=False)
+
+
+started = {}
+
+
+def start_task(task_id=None, task=None, **kwargs):
+    started[task_id] = time.time()
+
+
+def finish_task(task_id=None, task=None, **kwargs):
+    start = started.pop(task_id, None)
+    if start is not None:
+        record_duration(task.name, time.time() - start)
+
+
+def record_duration(name, duration):
+    bucket = next(index for index, bound in enumerate(BUCKETS) if duration <= bound)
+    with state.transaction():
+        durations = state.get(DURATIONS, name, {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)})
+        durations['count'] += 1
+        durations['total'] += duration
+        durations['max'] = max(durations['max'], duration)
+        durations['buckets'][bucket] += 1
+        state.set(DURATIONS, name, durations)
+
+
+def record_limit(sender=None, exception=None, **kwargs):
+    from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+    if isinstance(exception, (SoftTimeLimitExceeded, TimeLimitExceeded)):
+        name = getattr(sender, 'name', str(sender))
+        print('Task %s hit its time limit: %r' % (name, exception))
+        state.increment(LIMITS, '%s %s' % (name, type(exception).__name__))
+
+
+def percentile(durations, fraction):
+    '''The upper bound of the bucket the given fraction of the durations falls in.'''
+    wanted = durations['count'] * fraction
+    seen = 0
+    for bound, count in zip(BUCKETS, durations['buckets']):
+        seen += count
+        if seen >= wanted:
+            return min(bound, durations['max'])
+    return durations['max']
+
+
+def get_task_stats():
+    stats = {}
+    for name, durations in state.items(DURATIONS):
+        stats[name] = {
+            'count': durations['count'],
+            'average': durations['total'] / durations['count'] if durations['count'] else 0.0,
+            'p50': percentile(durations, 0.5),
+            'p99': percentile(durations, 0.99),
+            'max': durations['max'],
+        }
+    return stats
+
+
+def get_stuck_calls():
+    return dict(state.items(STUCK))
+
+
+def get_limit_hits():
+    return dict(state.items(LIMITS))
@@ -0,0 +1,254 @@
+'''Lightweight tracing spans and an opt-in profiler for finding where a run spends its time.
+
+Spans nest per thread: every celery task is a root span, the phases of a run (configuration,
+listing, settings, writes) are its children and each GitHub API call is a leaf. A trace is
+exported when its root span ends, as JSON lines to TRACE_FILE and/or as OTLP/HTTP JSON to
+TRACE_ENDPOINT (a collector's `/v1/traces`). With neither set spans cost next to nothing.
+
+Tasks named in PROFILE_TASKS (comma separated, or "all") run under cProfile. Profiles slower than
+PROFILE_THRESHOLD seconds are written to PROFILE_DIRECTORY, keeping only the PROFILE_KEEP slowest,
+and open with `python -m pstats` or flamegraph tools such as snakeviz.
+'''
+import cProfile
+import json
+import os
+import threading
+import time
+import uuid
+from githuborganizer import CONFIG
+
+
+DEFAULT_PROFILE_DIRECTORY = '/tmp/gitorganizer/profiles'
+DEFAULT_PROFILE_KEEP = 20
+EXPORT_TIMEOUT = 5
+
+_local = threading.local()
+
+
+def is_enabled():
+    return 'TRACE_FILE' in CONFIG or 'TRACE_ENDPOINT' in CONFIG
+
+
+def get_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+        _local.finished = []
+    return _local.stack
+
+
+class Span:
+
+    def __repr__(self):
+        return 'OrganizerSpan %s %0.3fs' % (self.name, self.duration or 0)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.duration = None
+        # Spans finished in other threads under this trace, exported with it (see `continued`).
+        self.remote = []
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        stack = get_stack()
+        parent = stack[-1] if stack else None
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = uuid.uuid4().hex[:16]
+        self.root = parent.root if parent else self
+        self.start = time.time()
+        self._clock = time.perf_counter()
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self._clock
+        if exc_type is not None:
+            self.attributes['error'] = '%s: %s' % (exc_type.__name__, exc)
+        stack = get_stack()
+        if self in stack:
+            stack.remove(self)
+        _local.finished.append(self)
+        if self.parent_id is None:
+            finished, _local.finished = _local.finished, []
+            export(finished + self.remote)
+        return False
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+
+class NoopSpan:
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def span(name, **attributes):
+    if not is_enabled():
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+
+def current_span():
+    '''The innermost open span of this thread, or None.'''
+    stack = get_stack()
+    return stack[-1] if stack else None
+
+
+class continued:
+    '''Open spans in another thread, such as a pool worker, as children of parent.
+
+    Without it each worker thread has an empty span stack and its spans start traces of their own.
+    '''
+
+    def __init__(self, parent):
+        self.parent = parent
+
+    def __enter__(self):
+        if self.parent is not None:
+            get_stack().append(self.parent)
+        return self.parent
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.parent is None:
+            return False
+        stack = get_stack()
+        if self.parent in stack:
+            stack.remove(self.parent)
+        # Handed to the root span, which exports them with the rest of its trace.
+        finished, _local.finished = _local.finished, []
+        self.parent.root.remote.extend(finished)
+        return False
+
+
+def export(spans):
+    if 'TRACE_FILE' in CONFIG:
+        try:
+            with open(CONFIG['TRACE_FILE'], 'a') as fd:
+                for finished in spans:
+                    fd.write(json.dumps(finished.as_dict(), default=str) + '\n')
+        except OSError as error:
+            print('Unable to write traces to %s: %s' % (CONFIG['TRACE_FILE'], error))
+    if 'TRACE_ENDPOINT' in CONFIG:
+        import requests
+        try:
+            requests.post(CONFIG['TRACE_ENDPOINT'], json=otlp_payload(spans), timeout=EXPORT_TIMEOUT)
+        except requests.RequestException as error:
+            print('Unable to send traces to %s: %s' % (CONFIG['TRACE_ENDPOINT'], error))
+
+
+def otlp_payload(spans):
+    '''Format spans as an OTLP/HTTP JSON export request.'''
+    otlp_spans = []
+    for finished in spans:
+        otlp_span = {
+            'traceId': finished.trace_id,
+            'spanId': finished.span_id,
+            'name': finished.name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(finished.start * 1e9)),
+            'endTimeUnixNano': str(int((finished.start + finished.duration) * 1e9)),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in finished.attributes.items()],
+        }
+        if finished.parent_id:
+            otlp_span['parentSpanId'] = finished.parent_id
+        if 'error' in finished.attributes:
+            otlp_span['status'] = {'code': 2, 'message': finished.attributes['error']}
+        otlp_spans.append(otlp_span)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'githuborganizer'}}]},
+        'scopeSpans': [{'scope': {'name': 'githuborganizer'}, 'spans': otlp_spans}],
+    }]}
+
+
+def should_profile(task_name):
+    tasks = [name.strip() for name in CONFIG.get('PROFILE_TASKS', '').split(',') if name.strip()]
+    if 'all' in tasks:
+        return True
+    return task_name in tasks or task_name.rsplit('.', 1)[-1] in tasks
+
+
+class Profile:
+    '''Run a block under cProfile and keep the result if it was one of the slowest.'''
+
+    def __init__(self, name, directory=None, threshold=None, keep=None):
+        self.name = name
+        self.directory = directory or CONFIG.get('PROFILE_DIRECTORY', DEFAULT_PROFILE_DIRECTORY)
+        self.threshold = float(threshold if threshold is not None else CONFIG.get('PROFILE_THRESHOLD', 0))
+        self.keep = int(keep or CONFIG.get('PROFILE_KEEP', DEFAULT_PROFILE_KEEP))
+        self.path = None
+
+    def __enter__(self):
+        self.profiler = cProfile.Profile()
+        self._clock = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.profiler.disable()
+        duration = time.perf_counter() - self._clock
+        if duration >= self.threshold:
+            self.save(duration)
+        return False
+
+    def save(self, duration):
+        os.makedirs(self.directory, exist_ok=True)
+        # Leading with the duration makes the slowest profiles sort last.
+        filename = '%012.3f-%s-%s.prof' % (duration, self.name.replace('/', '_'), int(time.time()))
+        self.path = os.path.join(self.directory, filename)
+        self.profiler.dump_stats(self.path)
+        print('Profile of %s (%0.3f seconds) saved to %s' % (self.name, duration, self.path))
+        profiles = sorted(name for name in os.listdir(self.directory) if name.endswith('.prof'))
+        for name in profiles[:max(0, len(profiles) - self.keep)]:
+            os.remove(os.path.join(self.directory, name))
+
+
+_tasks = {}
+
+
+def start_task(task_id=None, task=None, **kwargs):
+    running = {}
+    if should_profile(task.name):
+        running['profile'] = Profile(task.name).__enter__()
+    running['span'] = span('task %s' % (task.name,), task_id=task_id).__enter__()
+    _tasks[task_id] = running
+
+
+def finish_task(task_id=None, task=None, state=None, **kwargs):
+    running = _tasks.pop(task_id, None)
+    if not running:
+        return
+    running['span'].set('state', state)
+    running['span'].__exit__(None, None, None)
+    if 'profile' in running:
+        running['profile'].__exit__(None, None, None)
+
+
+def instrument_tasks():
+    '''Wrap every task the worker runs in a root span, profiling it when asked to.'''
+    from celery.signals import task_prerun, task_postrun
+    task_prerun.connect(start_task, weak=False)
+    task_postrun.connect(finish_task, weak=False)
@@ -0,0 +1,78 @@
+'''Spread periodic organization sweeps evenly over the sweep interval.
+
+`process_installs` used to queue every organization's sweep the moment it ran, so the broker, the
+workers and every installation's rate limit saw a spike followed by idle time. Each organization
+now has a stable offset into the interval, taken from a hash of its name, and its sweep is
+planned for the next time that offset comes around, give or take a little random jitter so
+organizations that hash close together do not line up. Planned sweeps live in the state store and
+the periodic scheduler dispatch hands out the ones that are due.
+'''
+import hashlib
+import random
+import time
+from githuborganizer import CONFIG
+from githuborganizer.services import state
+
+
+SWEEPS = 'planned_sweeps'
+
+DEFAULT_INTERVAL = 60 * 60 # One hour
+JITTER_FRACTION = 0.02
+
+
+def get_interval():
+    '''PROCESS_INSTALLS_INTERVAL is in minutes, like the worker's beat schedule.'''
+    if 'PROCESS_INSTALLS_INTERVAL' in CONFIG:
+        return float(CONFIG['PROCESS_INSTALLS_INTERVAL']) * 60.0
+    return DEFAULT_INTERVAL
+
+
+def get_jitter(interval):
+    if 'SWEEP_JITTER' in CONFIG:
+        return float(CONFIG['SWEEP_JITTER'])
+    return interval * JITTER_FRACTION
+
+
+def get_offset(tenant, interval):
+    '''Where in every interval the tenant's sweep belongs, the same on every worker and run.'''
+    digest = hashlib.sha1(tenant.encode('utf-8')).hexdigest()
+    return int(digest[:12], 16) / float(16 ** 12) * interval
+
+
+def next_due(tenant, interval, now=None, jitter=None):
+    now = time.time() if now is None else now
+    jitter = get_jitter(interval) if jitter is None else jitter
+    offset = get_offset(tenant, interval)
+    due = now - (now % interval) + offset
+    if due < now:
+        due += interval
+    return due + random.uniform(-jitter, jitter)
+
+
+def plan(tenant, full=False, interval=None):
+    '''Plan the tenant's next sweep, unless one is already planned. Returns when it is due.'''
+    interval = interval or get_interval()
+    with state.transaction():
+        planned = state.get(SWEEPS, tenant)
+        if planned:
+            if full and not planned['full']:
+                planned['full'] = True
+                state.set(SWEEPS, tenant, planned)
+            return planned['due']
+        due = next_due(tenant, interval)
+        state.set(SWEEPS, tenant, {'due': due, 'full': full}, expire=interval * 2)
+    return due
+
+
+def pop_due(now=None):
+    '''Remove and return the (tenant, full) sweeps that are due.'''
+    now = time.time() if now is None else now
+    with state.transaction():
+        due = [(tenant, planned) for tenant, planned in state.items(SWEEPS) if planned['due'] <= now]
+        for tenant, _ in due:
+            state.delete(SWEEPS, tenant)
+    return [(tenant, planned['full']) for tenant, planned in due]
+
+
+def get_planned():
+    return dict(state.items(SWEEPS))
@@ -1,204 +1,520 @@
-from githuborganizer import celery
+from celery.exceptions import SoftTimeLimitExceeded
+from githuborganizer import celery, scheduler, sweeps
 import githuborganizer.models.gh as gh
-from githuborganizer.services.github import ghapp, get_organization_client
+from githuborganizer.models import default_branches, fingerprints, mirror, permissions, runs, watermarks
+from githuborganizer.services import batch, leases, throttle
+from githuborganizer.services.github import ghapp, get_installation, get_organization_client
+import requests
+import time
+import uuid
 
 
 @celery.task(rate_limit='4/h', max_retries=0)
-def process_installs(synchronous = False):
+def process_installs(synchronous = False, full = False):
     print('Initiating run of all installations.')
     for install_id in ghapp.get_installations():
         print('Install ID: %s' % (install_id))
         install = ghapp.get_installation(install_id)
         organization = install.get_organization()
         if synchronous:
-            update_organization_settings(organization)
+            update_organization_settings(organization, full=full)
             update_organization_teams(organization)
+            migrate_default_branches(organization)
         else:
-            update_organization_settings.delay(organization)
-            update_organization_teams.delay(organization)
+            # Rather than every organization at once, each sweep starts at its own point in the
+            # interval and dispatch_scheduled_tasks hands it out when that comes around.
+            due = sweeps.plan(organization, full=full)
+            print('Sweep of %s planned in %.0f seconds.' % (organization, max(0, due - time.time())))
 
 
-@celery.task(max_retries=0)
-def update_organization_settings(org_name, synchronous = False):
+def enqueue_organization_sweep(organization, full = False):
+    scheduler.enqueue(organization, update_organization_settings, organization, full=full)
+    scheduler.enqueue(organization, update_organization_teams, organization)
+    scheduler.enqueue(organization, refresh_organization_mirror, organization)
+    scheduler.enqueue(organization, migrate_default_branches, organization)
+
+
+# Late acknowledgement means a killed worker's message is redelivered and the run resumes.
+@celery.task(max_retries=0, acks_late=True, reject_on_worker_lost=True)
+def update_organization_settings(org_name, synchronous = False, full = False):
     print('Configuring all repos in %s.' % (org_name))
     ghclient = get_organization_client(org_name)
     org = gh.Organization(ghclient, org_name)
     if not org.configuration:
         print('Organization %s does not have a configuration file in %s/github' % (org_name, org_name))
         return False
-    for repo in org.get_repositories():
-        organizer_settings = repo.get_organizer_settings()
-        if synchronous:
-            update_repository_settings(org_name, repo.name)
-            if 'labels' in org.configuration:
-                update_repository_labels(org_name, repo.name)
-            if 'dependency_security' in organizer_settings:
-                update_repository_security_settings(org_name, repo.name)
-            if 'branches' in organizer_settings:
-                update_repo_branch_protection(org_name, repo.name, synchronous=True)
-        else:
-            update_repository_settings.delay(org_name, repo.name)
-            if 'labels' in org.configuration:
-                update_repository_labels.delay(org_name, repo.name)
-            if 'dependency_security' in organizer_settings:
-                update_repository_security_settings.delay(org_name, repo.name)
-            if 'branches' in organizer_settings:
-                update_repo_branch_protection.delay(org_name, repo.name)
+    mirror.record_configuration(org_name, org.configuration)
+    run = runs.OrganizationRun(org_name, org.configuration)
+    if run.resumed:
+        print('Resuming run %s for %s after %s.' % (run.run_id, org_name, run.cursor))
+    if not synchronous:
+        # Each page of the listing is its own task, so reconciling starts as soon as the first
+        # page arrives and no single task has to hold the whole organization.
+        # A resumed run hands out every page that was not finished, not only the latest one.
+        pages = run.get_open_pages() if run.resumed else []
+        if not pages:
+            run.open_page(run.page_cursor)
+            pages = [run.page_cursor]
+        for page_cursor in pages:
+            scheduler.enqueue(org_name, update_organization_settings_shard, org_name, run.run_id, page_cursor, full=full)
+        scheduler.dispatch()
+        return
+    # Pages stay open until they are reconciled, so a run killed partway through a page resumes
+    # on that page instead of the next one.
+    pending = (run.get_open_pages() if run.resumed else []) or [run.page_cursor]
+    for page_cursor in pending:
+        run.open_page(page_cursor)
+    while pending:
+        page_cursor = pending.pop(0)
+        if not run.claim_page(page_cursor, run.run_id):
+            print('Page %s of run %s is already being worked on.' % (page_cursor, run.run_id))
+            return
+        repositories, next_cursor = org.get_repository_page(page_cursor)
+        reconcile_repositories(org, run, repositories, synchronous=True, full=full)
+        if next_cursor and next_cursor not in pending:
+            run.open_page(next_cursor)
+            pending.append(next_cursor)
+        run.advance_page(next_cursor)
+        if run.close_page(page_cursor, last=not next_cursor):
+            finish_run(org_name, run)
 
 
-@celery.task(max_retries=0)
-def update_repository_settings(org_name, repo_name):
-    print('Updating the settings of repository %s/%s.' % (org_name, repo_name))
+@celery.task(max_retries=0, acks_late=True, reject_on_worker_lost=True)
+def update_organization_settings_shard(org_name, run_id, page_cursor=None, full=False, continuing=False):
     ghclient = get_organization_client(org_name)
     org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
-    repo.update_settings()
+    if not org.configuration:
+        return False
+    record = runs.get_run(org_name)
+    if not record or record['run_id'] != run_id or record['status'] != 'running':
+        print('Run %s for %s is no longer running.' % (run_id, org_name))
+        return False
+    run = runs.OrganizationRun(org_name, org.configuration)
+    if run.run_id != run_id:
+        # The configuration changed since the run started, so start listing again under the new one.
+        print('Configuration of %s changed, starting run %s from the first page.' % (org_name, run.run_id))
+        page_cursor = None
+        continuing = False
+        run.open_page(page_cursor)
+    if not run.is_page_open(page_cursor):
+        print('Page %s of run %s is already done.' % (page_cursor, run.run_id))
+        return False
+    # Redelivered messages keep their task id and so keep their claim on the page.
+    owner = update_organization_settings_shard.request.id or run.run_id
+    if not run.claim_page(page_cursor, owner):
+        print('Page %s of run %s is already being worked on.' % (page_cursor, run.run_id))
+        return False
+    repositories, next_cursor = org.get_repository_page(page_cursor)
+    if not continuing:
+        # A continuation's next page was handed out by the task it continues.
+        run.advance_page(next_cursor)
+        if next_cursor:
+            run.open_page(next_cursor)
+            scheduler.enqueue(org_name, update_organization_settings_shard, org_name, run.run_id, next_cursor, full=full)
+    try:
+        reconcile_repositories(org, run, repositories, synchronous=False, full=full, continuing=continuing)
+    except SoftTimeLimitExceeded:
+        # Aspects this page already handed off are marked queued on the run, and the new task
+        # counts those as handed off, so it only queues what this one did not get to.
+        print('Page %s of run %s ran out of time, continuing in a new task.' % (page_cursor, run.run_id))
+        run.release_page(page_cursor, owner)
+        scheduler.enqueue(org_name, update_organization_settings_shard, org_name, run.run_id, page_cursor, full=full, continuing=True)
+        scheduler.dispatch()
+        return False
+    # Shards run in parallel, so the last page is not necessarily the last one to finish.
+    if run.close_page(page_cursor, last=not next_cursor):
+        finish_run(org_name, run)
+    scheduler.dispatch()
 
 
-@celery.task(max_retries=0)
-def update_repository_security_settings(org_name, repo_name):
-    print('Updating the dependency security settings of repository %s/%s.' % (org_name, repo_name))
-    ghclient = get_organization_client(org_name)
-    org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
-    repo.update_security_scanning()
+def finish_run(org_name, run):
+    run.finish()
+    # Every repository the run listed is in the mirror now, so the rest are gone.
+    mirror.prune_repositories(org_name, run.run_id)
 
 
-@celery.task(max_retries=0)
-def update_repo_branch_protection(org_name, repo_name, synchronous = False):
+def reconcile_repositories(org, run, repositories, synchronous=False, full=False, continuing=False):
+    org_name = org.name
+    skipped = 0
+    for repo in repositories:
+        organizer_settings = repo.get_organizer_settings()
+        mirror.record_repository(org_name, repo.snapshot, profile=organizer_settings.profile if organizer_settings else False, listing=run.run_id)
+        if not organizer_settings:
+            continue
+        aspects = ['settings']
+        if 'labels' in org.configuration:
+            aspects.append('labels')
+        if organizer_settings.dependency_security:
+            aspects.append('security')
+        if organizer_settings.branches:
+            aspects.append('branches')
+        aspects = [aspect for aspect in aspects if not run.is_complete(repo.name, aspect, queued=continuing)]
+        if not full:
+            unchanged = [aspect for aspect in aspects if is_repository_aspect_current(repo, aspect)]
+            skipped += len(unchanged)
+            aspects = [aspect for aspect in aspects if aspect not in unchanged]
+        if not aspects:
+            continue
+        for aspect in aspects:
+            if synchronous:
+                with throttle.tracking() as writes:
+                    if aspect == 'settings':
+                        update_repository_settings(org_name, repo.name, repository_snapshot=repo.snapshot)
+                    elif aspect == 'labels':
+                        update_repository_labels(org_name, repo.name, repository_snapshot=repo.snapshot)
+                    elif aspect == 'security':
+                        update_repository_security_settings(org_name, repo.name, repository_snapshot=repo.snapshot)
+                    elif aspect == 'branches':
+                        update_repo_branch_protection(org_name, repo.name, synchronous=True, repository_snapshot=repo.snapshot)
+                # Deferred writes have not happened yet, so a resumed run has to try them again.
+                if not writes.deferred:
+                    run.mark(repo.name, aspect, runs.DONE)
+            else:
+                if aspect == 'settings':
+                    scheduler.enqueue(org_name, update_repository_settings, org_name, repo.name, repository_snapshot=repo.snapshot)
+                elif aspect == 'labels':
+                    scheduler.enqueue(org_name, update_repository_labels, org_name, repo.name, repository_snapshot=repo.snapshot)
+                elif aspect == 'security':
+                    scheduler.enqueue(org_name, update_repository_security_settings, org_name, repo.name, repository_snapshot=repo.snapshot)
+                elif aspect == 'branches':
+                    scheduler.enqueue(org_name, update_repo_branch_protection, org_name, repo.name, repository_snapshot=repo.snapshot)
+                # Only marked once really handed off, as continuations skip queued aspects. A task
+                # that finishes before this only leaves the aspect queued, to be redone on resume.
+                run.mark(repo.name, aspect, runs.QUEUED)
+        run.advance(repo.name)
+    if skipped:
+        print('Skipped %s unchanged repository settings in %s.' % (skipped, org_name))
+
+
+def record_fingerprint(repo, aspect, writes):
+    '''Only fingerprint settings that were really written, so deferred writes are not skipped later.'''
+    if writes.deferred:
+        print('%s write(s) to %s for %s were deferred, it will be checked again.' % (writes.deferred, repo.name, aspect))
+        return
+    fingerprints.record(repo, aspect)
+    # A run that queued the aspect can count it as done now. Branches are one aspect of the run
+    # but one task per branch, so they are done once every branch is.
+    run_aspect = aspect.split(':', 1)[0]
+    if run_aspect == aspect or is_repository_aspect_current(repo, run_aspect):
+        runs.complete(repo.organization.name, repo.name, run_aspect)
+
+
+def is_repository_aspect_current(repo, aspect):
+    if aspect != 'branches':
+        return fingerprints.is_current(repo, aspect)
+    branches = repo.get_organizer_settings().branches
+    return all(fingerprints.is_current(repo, 'branches:%s' % (branch)) for branch in branches)
+
+
+@celery.task(max_retries=0, acks_late=True, reject_on_worker_lost=True)
+def update_repository_settings(org_name, repo_name, repository_snapshot=None):
+    def reconcile(repository_snapshot):
+        print('Updating the settings of repository %s/%s.' % (org_name, repo_name))
+        ghclient = get_organization_client(org_name)
+        org = gh.Organization(ghclient, org_name)
+        repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
+        with throttle.tracking() as writes:
+            repo.update_settings()
+        record_fingerprint(repo, 'settings', writes)
+    return leases.reconcile(org_name, repo_name, 'settings', reconcile, repository_snapshot)
+
+
+@celery.task(max_retries=0, acks_late=True, reject_on_worker_lost=True)
+def update_repository_security_settings(org_name, repo_name, repository_snapshot=None):
+    def reconcile(repository_snapshot):
+        print('Updating the dependency security settings of repository %s/%s.' % (org_name, repo_name))
+        ghclient = get_organization_client(org_name)
+        org = gh.Organization(ghclient, org_name)
+        repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
+        with throttle.tracking() as writes:
+            repo.update_security_scanning()
+        record_fingerprint(repo, 'security', writes)
+    return leases.reconcile(org_name, repo_name, 'security', reconcile, repository_snapshot)
+
+
+@celery.task(max_retries=0, acks_late=True, reject_on_worker_lost=True)
+def update_repo_branch_protection(org_name, repo_name, synchronous = False, repository_snapshot=None):
     ghclient = get_organization_client(org_name)
     org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
+    repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
     settings = repo.get_organizer_settings()
-    if 'branches' not in settings:
+    if not settings or not settings.branches:
         return
-    for branch in settings['branches']:
+    for branch in settings.branches:
         if synchronous:
-            update_branch_protection(org_name, repo_name, branch)
+            update_branch_protection(org_name, repo_name, branch, repository_snapshot=repository_snapshot)
         else:
-            update_branch_protection.delay(org_name, repo_name, branch)
+            scheduler.enqueue(org_name, update_branch_protection, org_name, repo_name, branch, repository_snapshot=repository_snapshot)
+    if not synchronous:
+        scheduler.dispatch()
 
 
-@celery.task(max_retries=0)
-def update_branch_protection(org_name, repo_name, branch):
-    ghclient = get_organization_client(org_name)
-    org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
-    settings = repo.get_organizer_settings()
-    if 'branches' not in settings:
-        return
-    if branch not in settings['branches']:
-        return
-    print('Updating branch protection for %s in %s/%s.' % (branch, org_name, repo_name))
-    bsettings = settings['branches'][branch]
-
-    gh.branch_protection(
-        installation=ghclient.app,
-        repository=repo,
-        branch=branch,
-        required_status_checks=bsettings.get('required_status_checks', None),
-        enforce_admins=bsettings.get('enforce_admins', False),
-        required_pull_request_reviews=bsettings.get('required_pull_request_reviews', None),
-        restrictions=bsettings.get('restrictions', None),
-        required_linear_history=bsettings.get('required_linear_history', False),
-        allow_force_pushes=bsettings.get('allow_force_pushes', False),
-        allow_deletions=bsettings.get('allow_deletions', False),
-        required_approving_review_count=bsettings.get('required_approving_review_count', 1),
-        require_code_owner_reviews=bsettings.get('require_code_owner_reviews',False),
-        dismiss_stale_reviews=bsettings.get('dismiss_stale_reviews', True)
-        )
+@celery.task(max_retries=0, acks_late=True, reject_on_worker_lost=True)
+def update_branch_protection(org_name, repo_name, branch, repository_snapshot=None):
+    def reconcile(repository_snapshot):
+        ghclient = get_organization_client(org_name)
+        org = gh.Organization(ghclient, org_name)
+        repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
+        settings = repo.get_organizer_settings()
+        if not settings:
+            return
+        if branch not in settings.branches:
+            return
+        print('Updating branch protection for %s in %s/%s.' % (branch, org_name, repo_name))
+        bsettings = settings.branches[branch]
+
+        with throttle.tracking() as writes:
+            gh.branch_protection(
+                installation=ghclient.app,
+                repository=repo,
+                branch=branch,
+                required_status_checks=bsettings.required_status_checks,
+                enforce_admins=bsettings.enforce_admins,
+                required_pull_request_reviews=bsettings.required_pull_request_reviews,
+                restrictions=bsettings.restrictions,
+                required_linear_history=bsettings.required_linear_history,
+                allow_force_pushes=bsettings.allow_force_pushes,
+                allow_deletions=bsettings.allow_deletions,
+                required_approving_review_count=bsettings.required_approving_review_count,
+                require_code_owner_reviews=bsettings.require_code_owner_reviews,
+                dismiss_stale_reviews=bsettings.dismiss_stale_reviews
+                )
+        record_fingerprint(repo, 'branches:%s' % (branch), writes)
+    return leases.reconcile(org_name, repo_name, 'branches:%s' % (branch), reconcile, repository_snapshot)
 
 
 @celery.task(max_retries=0)
 def update_repository_default_branch(org_name, repo_name):
-    ghclient = get_organization_client(org_name)
-    org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
-    repo.update_default_branch()
+    def reconcile(repository_snapshot):
+        ghclient = get_organization_client(org_name)
+        org = gh.Organization(ghclient, org_name)
+        repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
+        repo.update_default_branch()
+    return leases.reconcile(org_name, repo_name, 'default_branch', reconcile)
 
 
 @celery.task(max_retries=0)
-def update_repository_labels(org_name, repo_name):
-    print('Updating the labels of repository %s/%s.' % (org_name, repo_name))
+def migrate_default_branches(org_name, dry_run = False):
     ghclient = get_organization_client(org_name)
     org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
-    repo.update_labels()
+    if not org.configuration:
+        return False
+    if dry_run:
+        return default_branches.plan(org)
+    progress = {}
+    def reconcile(repository_snapshot):
+        changes = default_branches.plan(org)
+        if not changes:
+            return
+        # Webhooks move single repositories under that repository's lease, so take the same
+        # leases and leave repositories that one is already moving to it.
+        with leases.RepositoryLeases(org_name, [change['repository'] for change in changes], 'default_branch') as held:
+            changes = [change for change in changes if change['repository'] in held.acquired]
+            if changes:
+                print('Moving %s repositories in %s to their configured default branch.' % (len(changes), org_name))
+                progress.update(default_branches.migrate(org, changes))
+                print('Default branch migration of %s: %s updated, %s failed, %s deferred.' % (
+                    org_name, progress['updated'], progress['failed'], progress['deferred']))
+        for repo_name in held.requested:
+            scheduler.enqueue(org_name, update_repository_default_branch, org_name, repo_name)
+        if held.requested:
+            scheduler.dispatch()
+    # Sweeps and the CLI can both start a migration, only one runs per organization at a time.
+    if not leases.reconcile(org_name, '*', 'default_branch', reconcile):
+        return False
+    return progress or None
+
+
+@celery.task(max_retries=0, acks_late=True, reject_on_worker_lost=True)
+def update_repository_labels(org_name, repo_name, repository_snapshot=None):
+    def reconcile(repository_snapshot):
+        print('Updating the labels of repository %s/%s.' % (org_name, repo_name))
+        ghclient = get_organization_client(org_name)
+        org = gh.Organization(ghclient, org_name)
+        repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
+        with throttle.tracking() as writes:
+            repo.update_labels()
+        record_fingerprint(repo, 'labels', writes)
+    return leases.reconcile(org_name, repo_name, 'labels', reconcile, repository_snapshot)
 
 
 @celery.task(max_retries=0)
 def update_organization_teams(org_name):
+    def reconcile(repository_snapshot):
+        ghclient = get_organization_client(org_name)
+        org = gh.Organization(ghclient, org_name)
+        # Repositories are listed once, keeping only what their configuration says about teams.
+        # Teams are then looked up and reconciled one at a time, so only one team's permission
+        # masks are held at once rather than every team's for every repository.
+        configured = {}
+        for repository in org.get_repositories():
+            repo_config = repository.get_organizer_settings()
+            if repo_config:
+                configured[repository.name] = (repo_config.teams, repo_config.teams_clean)
+        names = set()
+        for ghteam in org.ghorg.teams():
+            team = gh.get_team_access(org.client.app, ghteam)
+            mirror.record_team(org_name, team)
+            names.add(team.name)
+            reconcile_team(org, team, configured)
+        mirror.prune_teams(org_name, names)
+    # Team permissions are reconciled for the whole organization at once.
+    return leases.reconcile(org_name, '*', 'teams', reconcile)
+
+
+def reconcile_team(org, team, configured):
+    for repo_name, (repo_teams, teams_clean) in configured.items():
+        current = team.get_permissions(repo_name)
+        repo_full_name = '%s/%s' % (org.name, repo_name)
+        if team.name in repo_teams:
+            permission = repo_teams[team.name]
+            if not current & permissions.from_name(permission):
+                print('Team %s adding %s permission on %s.' % (team.name, permission, repo_full_name))
+                gh.set_team_repository_permission(org.client.app, team, repo_full_name, permission)
+            elif permission == 'pull' and permissions.count(current) > 1:
+                print('Team %s setting %s permission on %s.' % (team.name, permission, repo_full_name))
+                gh.set_team_repository_permission(org.client.app, team, repo_full_name, permission)
+            elif permission == 'push' and permissions.count(current) > 2:
+                print('Team %s setting %s permission on %s.' % (team.name, permission, repo_full_name))
+                gh.set_team_repository_permission(org.client.app, team, repo_full_name, permission)
+        elif teams_clean and current:
+            print('Team %s removing %s permissions on %s.' % (team.name, ', '.join(permissions.names(current)), repo_full_name))
+            gh.remove_team_repository(org.client.app, team, repo_full_name)
+
+
+@celery.task(max_retries=0)
+def refresh_organization_mirror(org_name, everything = False):
+    '''Add the organization's projects to the mirror.
+
+    Sweeps already record the configuration, repositories and teams as they reconcile them, so
+    only the CLI asks for everything, to fill in a mirror without waiting for a sweep.
+    '''
     ghclient = get_organization_client(org_name)
     org = gh.Organization(ghclient, org_name)
-    repositories = [x for x in org.get_repositories()]
-    for ghteam in org.ghorg.teams():
-        repo_permissions = gh.team_has_repositories(org.client.app, ghteam)
-        for repository in repositories:
-            repo_config = repository.get_organizer_settings()
-            current = repo_permissions.get(repository.name, [])
-            repo_full_name = '%s/%s' % (org.name, repository.name)
-            if 'teams' in repo_config and ghteam.name in repo_config['teams']:
-                permission = repo_config['teams'][ghteam.name]
-                if permission not in current:
-                    print('Team %s adding %s permission on %s.' % (ghteam.name, permission, repo_full_name))
-                    ghteam.add_repository(repo_full_name, permission)
-                elif permission == 'pull' and len(current) > 1:
-                    print('Team %s setting %s permission on %s.' % (ghteam.name, permission, repo_full_name))
-                    ghteam.add_repository(repo_full_name, permission)
-                elif permission == 'push' and len(current) > 2:
-                    print('Team %s setting %s permission on %s.' % (ghteam.name, permission, repo_full_name))
-                    ghteam.add_repository(repo_full_name, permission)
-            elif repo_config.get('teams_clean', False) and len(current) > 0:
-                print('Team %s removing %s permissions on %s.' % (ghteam.name, ', '.join(current), repo_full_name))
-                ghteam.remove_repository(repo_full_name)
+    if not org.configuration:
+        return False
+    if everything:
+        mirror.record_configuration(org_name, org.configuration)
+        listing = uuid.uuid4().hex
+        for repo in org.get_repositories():
+            organizer_settings = repo.get_organizer_settings()
+            mirror.record_repository(org_name, repo.snapshot, profile=organizer_settings.profile if organizer_settings else False, listing=listing)
+        mirror.prune_repositories(org_name, listing)
+        names = set()
+        for ghteam in org.ghorg.teams():
+            team = gh.get_team_access(ghclient.app, ghteam)
+            mirror.record_team(org_name, team)
+            names.add(team.name)
+        mirror.prune_teams(org_name, names)
+    projects = []
+    for project in org.get_projects():
+        columns = {column.name: column.id for column in project.get_columns()}
+        projects.append({'id': project.id, 'name': project.name, 'columns': columns})
+    mirror.record_projects(org_name, projects)
 
 
 @celery.task(default_retry_delay=65*60)
-def assign_issues(org_name, repo_name, synchronous = False):
+def assign_issues(org_name, repo_name, synchronous = False, full = False):
     ghclient = get_organization_client(org_name)
     org = gh.Organization(ghclient, org_name)
     repo = org.get_repository(repo_name)
     column = repo.get_autoassign_column()
     if not column:
         return False
-    for issue in repo.get_issues():
-        if synchronous:
-            assign_issue(org_name, repo_name, issue.number)
+    installation = ghclient.app
+    since = None if full else watermarks.get_watermark(org_name, repo_name, watermarks.ASSIGN)
+    issues = list(gh.list_open_issues(installation, org_name, repo_name, since=since))
+    unassigned = [issue for issue in issues if issue['project_cards'] == 0]
+    failed = set()
+    if batch.should_batch(unassigned):
+        # One mutation adds a card for many issues instead of a task and a request per issue.
+        column_id = column.as_dict()['node_id']
+        mutations = batch.MutationBatch(installation)
+        for issue in unassigned:
+            mutations.add('addProjectCard', {'projectColumnId': column_id, 'contentId': issue['node_id']})
+        for issue, result in zip(unassigned, mutations.execute()):
+            if isinstance(result, batch.MutationError):
+                print('Unable to assign issue %s to column %s: %s' % (issue['number'], column.name, result))
+            if result is batch.DEFERRED or isinstance(result, batch.MutationError):
+                failed.add(issue['number'])
+    else:
+        for issue in unassigned:
+            if synchronous:
+                if not assign_issue(org_name, repo_name, issue['number']):
+                    failed.add(issue['number'])
+            else:
+                scheduler.enqueue(org_name, assign_issue, org_name, repo_name, issue['number'])
+        if not synchronous:
+            scheduler.dispatch()
+    # Queued tasks count as handled, the scheduler queue is persistent. Issues assigned here
+    # only count once their card was created.
+    handled = [issue['number'] not in failed for issue in issues]
+    watermarks.advance(org_name, repo_name, watermarks.ASSIGN, watermarks.handled_until(issues, handled))
+
+
+@celery.task(default_retry_delay=65*60)
+def label_issues(org_name, repo_name, synchronous = False, full = False):
+    ghclient = get_organization_client(org_name)
+    org = gh.Organization(ghclient, org_name)
+    repo = org.get_repository(repo_name)
+    autoassign_labels = repo.get_autoassign_labels()
+    if not autoassign_labels:
+        return False
+    since = None if full else watermarks.get_watermark(org_name, repo_name, watermarks.LABEL)
+    issues = list(gh.list_open_issues(ghclient.app, org_name, repo_name, since=since))
+    handled = []
+    for issue in issues:
+        if autoassign_labels <= set(issue['labels']):
+            handled.append(True)
+        elif synchronous:
+            handled.append(label_issue(org_name, repo_name, issue['number'], existing_labels=issue['labels']))
         else:
-            assign_issue.delay(org_name, repo_name, issue.number)
+            scheduler.enqueue(org_name, label_issue, org_name, repo_name, issue['number'], existing_labels=issue['labels'])
+            # Its write may still be deferred or fail, so the next run looks at it again. Once
+            # labeled it needs no change and the watermark moves past it.
+            handled.append(False)
+    if not synchronous:
+        scheduler.dispatch()
+    watermarks.advance(org_name, repo_name, watermarks.LABEL, watermarks.handled_until(issues, handled))
 
 
 @celery.task(default_retry_delay=65*60)
-def assign_issue(org_name, repo_name, issue_number):
-    installation = ghapp.get_org_installation(org_name)
+def assign_issue(org_name, repo_name, issue_number, repository_snapshot=None, issue_snapshot=None, installation_id=False):
+    '''Add an issue to the autoassign column, returning True once it is in a project.'''
+    installation = get_installation(org_name, installation_id)
     ghclient = installation.get_github3_client()
     org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
+    repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
     column = repo.get_autoassign_column()
     if not column:
         print('No autoassign column found')
         return False
     if gh.issue_has_projects(installation, org_name, repo_name, issue_number):
         print('Already assigned to a project')
-        return False
+        return True
     print('Assigning issue %s to column %s' % (issue_number, column.name))
-    issue = repo.get_issue(issue_number)
-    if not column.create_card_with_issue(issue):
+    issue_id = repo.get_issue_id(issue_number, issue_snapshot)
+    if not column.create_card_with_content_id(issue_id, 'Issue'):
         print('Unable to assign issue %s to column %s' % (issue_number, column.name))
+        return False
+    return True
 
 
 @celery.task(default_retry_delay=65*60)
-def label_issue(org_name, repo_name, issue_number):
-    installation = ghapp.get_org_installation(org_name)
+def label_issue(org_name, repo_name, issue_number, existing_labels=None, repository_snapshot=None, installation_id=False):
+    '''Add the missing auto labels to an issue, returning True unless the write was deferred.'''
+    installation = get_installation(org_name, installation_id)
     ghclient = installation.get_github3_client()
     org = gh.Organization(ghclient, org_name)
-    repo = org.get_repository(repo_name)
+    repo = org.get_repository(repo_name, repository_snapshot=repository_snapshot)
     autoassign_labels = repo.get_autoassign_labels()
     if not autoassign_labels:
-        return
-    issue = repo.get_issue(issue_number)
-    for label in autoassign_labels:
-        issue.add_labels(label)
+        return True
+    # Without the existing labels from the webhook we add them all, which is harmless.
+    missing_labels = autoassign_labels - set(existing_labels or [])
+    if not missing_labels:
+        return True
+    return gh.add_issue_labels(installation, org_name, repo_name, issue_number, sorted(missing_labels)) is not False
 
 
 @celery.task(max_retries=0)
@@ -215,7 +531,9 @@ def update_organization_team_members(org_name, synchronous = False):
         if synchronous:
             update_team_members(org_name, team)
         else:
-            update_team_members.delay(org_name, team)
+            scheduler.enqueue(org_name, update_team_members, org_name, team)
+    if not synchronous:
+        scheduler.dispatch()
 
 
 @celery.task(max_retries=0)
@@ -245,3 +563,29 @@ def update_team_members(org_name, team_name):
         if member not in existing:
             print('Adding %s to team "%s" in organization "%s"' % (member, team_name, org_name))
             team.add_or_update_membership(member)
+
+
+@celery.task(max_retries=0)
+def dispatch_scheduled_tasks():
+    for organization, full in sweeps.pop_due():
+        print('Starting planned sweep of %s.' % (organization))
+        enqueue_organization_sweep(organization, full=full)
+    dispatched = scheduler.dispatch()
+    if dispatched:
+        print('Dispatched %s scheduled tasks.' % (dispatched))
+
+
+@celery.task(max_retries=0)
+def retry_deferred_writes():
+    for operation in throttle.pop_due():
+        installation = ghapp.get_installation(operation['installation'])
+        print('Retrying %s %s (attempt %s).' % (operation['verb'].upper(), operation['url'], operation['attempt']))
+        try:
+            installation.rest(
+                operation['verb'],
+                url=operation['url'],
+                payload=operation['payload'],
+                accepts=operation['accepts'],
+                attempt=operation['attempt'])
+        except requests.HTTPError as error:
+            print('Deferred %s %s failed: %s' % (operation['verb'].upper(), operation['url'], error))
@@ -1,8 +1,13 @@
 from celery.schedules import crontab
 from githuborganizer.tasks import github
+from githuborganizer.services import tracing
 from githuborganizer import celery
 import os
 
+# The celery command line needs the real application rather than the lazy stand in.
+celery = celery.get()
+tracing.instrument_tasks()
+
 if os.environ.get('PROCESS_INSTALLS_INTERVAL', False):
     @celery.on_after_finalize.connect
     def setup_periodic_tasks(sender, **kwargs):
@@ -11,3 +16,19 @@ if os.environ.get('PROCESS_INSTALLS_INTERVAL', False):
             float(os.environ['PROCESS_INSTALLS_INTERVAL']) * 60.0,
             github.process_installs.s(),
             name='Root Task - Schedule Installation Jobs')
+
+
+@celery.on_after_finalize.connect
+def setup_scheduler_dispatch(sender, **kwargs):
+    sender.add_periodic_task(
+        float(os.environ.get('SCHEDULER_INTERVAL', 30)),
+        github.dispatch_scheduled_tasks.s(),
+        name='Dispatch fairly scheduled installation work')
+
+
+@celery.on_after_finalize.connect
+def setup_write_retries(sender, **kwargs):
+    sender.add_periodic_task(
+        60.0,
+        github.retry_deferred_writes.s(),
+        name='Retry rate limited writes')
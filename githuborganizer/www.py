@@ -1,10 +1,17 @@
 from fastapi import FastAPI
 from typing import Dict, Any
 from starlette.requests import Request
+from starlette.responses import JSONResponse
 import githuborganizer.tasks.github as tasks
+from githuborganizer import backpressure
+from githuborganizer.models import mirror
+from githuborganizer.services.github import ghapp
+from githuborganizer.models.snapshot import issue_snapshot, repository_snapshot
 
 app = FastAPI()
 
+HANDLED_EVENTS = ['issues', 'repository', 'installation', 'installation_repositories']
+
 
 @app.post("/githook")
 def github_webhook(data: Dict[str, Any], request: Request):
@@ -18,6 +25,11 @@ def github_webhook(data: Dict[str, Any], request: Request):
     if not event:
         return 'No event detected.'
 
+    if event in HANDLED_EVENTS and backpressure.should_shed(event):
+        backpressure.record(backpressure.REJECTED)
+        return JSONResponse('Queues are backed up, try again later.', status_code=503,
+            headers={'Retry-After': str(backpressure.retry_after())})
+
     if event == 'issues':
         return issue_payload(data)
 
@@ -40,18 +52,42 @@ def issue_payload(payload):
     issue_number = payload['issue']['number']
     repository = payload['repository']['name']
     organization = payload['repository']['full_name'].split('/')[0]
-    tasks.assign_issue.delay(organization, repository, issue_number)
-    tasks.label_issue.delay(organization, repository, issue_number)
+    repo_snapshot = repository_snapshot(payload['repository'])
+    issue = issue_snapshot(payload['issue'])
+    installation_id = payload.get('installation', {}).get('id', False)
+    tasks.assign_issue.delay(organization, repository, issue_number,
+        repository_snapshot=repo_snapshot,
+        issue_snapshot=issue,
+        installation_id=installation_id)
+    tasks.label_issue.delay(organization, repository, issue_number,
+        existing_labels=issue.get('labels', []),
+        repository_snapshot=repo_snapshot,
+        installation_id=installation_id)
     return 'Processing issue #%s on %s/%s.' % (issue_number, organization, repository)
 
 
 def repository_payload(payload):
-    if payload['action'] not in ['created', 'unarchived']:
-        return
     organization = payload['repository']['owner']['login']
     repository = payload['repository']['name']
-    tasks.update_repository_settings.delay(organization, repository)
-    tasks.update_repository_labels.delay(organization, repository)
+    if payload['action'] == 'deleted':
+        mirror.remove_repository(organization, repository)
+        return
+    if payload['action'] == 'renamed':
+        mirror.remove_repository(organization, payload['changes']['repository']['name']['from'])
+    if payload['action'] == 'transferred':
+        previous_owner = payload.get('changes', {}).get('owner', {}).get('from', {})
+        previous_owner = previous_owner.get('organization') or previous_owner.get('user') or {}
+        if 'login' in previous_owner:
+            mirror.remove_repository(previous_owner['login'], repository)
+    mirror.record_repository(organization, payload['repository'])
+    if payload['action'] not in ['created', 'unarchived']:
+        return
+    repo_snapshot = repository_snapshot(payload['repository'])
+    level = backpressure.get_level()
+    backpressure.submit(organization, tasks.update_repository_settings, (organization, repository), {'repository_snapshot': repo_snapshot}, level=level)
+    outcome = backpressure.submit(organization, tasks.update_repository_labels, (organization, repository), {'repository_snapshot': repo_snapshot}, level=level)
+    if outcome == backpressure.DEFERRED:
+        return 'Deferred %s/%s to the next sweep of %s.' % (organization, repository, organization)
     return 'Processing %s/%s.' % (organization, repository)
 
 
@@ -61,15 +97,21 @@ def installation_payload(payload):
     install_id = payload['installation']['id']
     install = ghapp.get_installation(install_id)
     organization = install.get_organization()
-    update_organization_settings.delay(organization)
+    if backpressure.submit(organization, tasks.update_organization_settings, (organization,)) == backpressure.DEFERRED:
+        return 'Deferred organization %s to its next sweep.' % organization
     return 'Processing organization %s.' % organization
 
 
 def installation_repositories(payload):
+    for repository in payload.get('repositories_removed', []):
+        mirror.remove_repository(repository['full_name'].split('/')[0], repository['name'])
     if payload['action'] != 'added':
         return
+    level = backpressure.get_level()
     for repository in payload['repositories_added']:
         organization = repository['full_name'].split('/')[0]
-        tasks.update_repository_settings.delay(organization, repository['name'])
-        tasks.update_repository_labels.delay(organization, repository['name'])
+        mirror.record_repository(organization, repository)
+        repo_snapshot = repository_snapshot(repository)
+        backpressure.submit(organization, tasks.update_repository_settings, (organization, repository['name']), {'repository_snapshot': repo_snapshot}, level=level)
+        backpressure.submit(organization, tasks.update_repository_labels, (organization, repository['name']), {'repository_snapshot': repo_snapshot}, level=level)
     return 'Processing new repositories.'